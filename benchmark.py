@@ -0,0 +1,285 @@
+"""
+Throughput, latency and memory benchmarks for the allocation hot paths.
+
+Run `python benchmark.py --help` for the options. Results can be saved as a
+baseline and later runs compared against it, exiting non-zero when a path
+got slower than the allowed tolerance.
+"""
+import argparse
+from dataclasses import asdict
+from dataclasses import dataclass
+from datetime import date
+from datetime import timedelta
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_tables import metadata
+import model
+import parallel
+import respository
+
+
+@dataclass
+class InventorySpec:
+    """Shape of a synthetic inventory"""
+    skus: int = 50
+    batches_per_sku: int = 10
+    lines_per_batch: int = 20
+    eta_spread_days: int = 30
+    seed: int = 0
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    operations: int
+    ops_per_sec: float
+    p50_ms: float
+    p99_ms: float
+    peak_memory_kb: float
+
+
+def generate_inventory(spec: InventorySpec) -> Tuple[List[model.Batch], List[model.OrderLine]]:
+    """
+    Build batches, each already holding `lines_per_batch` allocations, and a list of
+    fresh order lines (one per existing allocation) to allocate against them
+    """
+    rng = random.Random(spec.seed)
+    today = date.today()
+    batches, lines = [], []
+    for s in range(spec.skus):
+        sku = f"SKU-{s}"
+        for b in range(spec.batches_per_sku):
+            eta = None if rng.random() < 0.2 else today + timedelta(days=rng.randrange(spec.eta_spread_days + 1))
+            batch = model.Batch(f"batch-{s}-{b}", sku, spec.lines_per_batch * 20, eta)
+            for i in range(spec.lines_per_batch):
+                batch.allocate(model.OrderLine(f"order-{s}-{b}-{i}", sku, rng.randrange(1, 10)))
+            batches.append(batch)
+            lines.extend(
+                model.OrderLine(f"new-order-{s}-{b}-{i}", sku, rng.randrange(1, 10))
+                for i in range(spec.lines_per_batch)
+            )
+    rng.shuffle(lines)
+    return batches, lines
+
+
+def measure(name: str, make_operations: Callable[[], List[Callable[[], object]]]) -> BenchmarkResult:
+    """
+    Time each operation individually, then replay a fresh set of operations under
+    tracemalloc for peak memory, so tracing overhead does not skew the timings
+    """
+    operations = make_operations()
+    latencies = []
+    started = time.perf_counter()
+    for operation in operations:
+        begin = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+
+    replay = make_operations()
+    tracemalloc.start()
+    try:
+        for operation in replay:
+            operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    def percentile(fraction: float) -> float:
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+
+    return BenchmarkResult(
+        name=name,
+        operations=len(operations),
+        ops_per_sec=len(operations) / elapsed if elapsed else float("inf"),
+        p50_ms=percentile(0.50),
+        p99_ms=percentile(0.99),
+        peak_memory_kb=peak / 1024,
+    )
+
+
+def bench_model(spec: InventorySpec) -> List[BenchmarkResult]:
+    def allocate_lines():
+        batches, lines = generate_inventory(spec)
+        return [lambda line=line: _allocate_or_none(line, batches) for line in lines]
+
+    def allocate_to_batches():
+        batches, lines = generate_inventory(spec)
+        by_sku: Dict[str, model.Batch] = {batch.sku: batch for batch in batches}
+        return [lambda line=line: by_sku[line.sku].allocate(line) for line in lines]
+
+    return [
+        measure("model.allocate", allocate_lines),
+        measure("Batch.allocate", allocate_to_batches),
+    ]
+
+
+def bench_bulk(spec: InventorySpec) -> List[BenchmarkResult]:
+    """The whole set of new lines allocated in one call, in this process and across worker processes"""
+    def allocate_all(allocate):
+        batches, lines = generate_inventory(spec)
+        return [lambda: allocate(lines, batches)]
+
+    return [
+        measure("model.allocate_many", lambda: allocate_all(model.allocate_many)),
+        measure("parallel.allocate_in_parallel", lambda: allocate_all(parallel.allocate_in_parallel)),
+    ]
+
+
+def _allocate_or_none(line: model.OrderLine, batches: List[model.Batch]):
+    try:
+        return model.allocate(line, batches)
+    except model.OutOfStock:
+        return None
+
+
+def bench_repository(spec: InventorySpec, label: str, url: str) -> List[BenchmarkResult]:
+    engine = create_engine(url)
+    session_factory = sessionmaker(bind=engine)
+
+    def add_batches():
+        # every run of the add benchmark starts from empty tables
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+        batches, _ = generate_inventory(spec)
+        return [lambda batch=batch: add(batch) for batch in batches]
+
+    def add(batch):
+        session = session_factory()
+        respository.SqlRepository(session).add(batch)
+        session.commit()
+        session.close()
+
+    def read(call):
+        session = session_factory()
+        call(respository.SqlRepository(session))
+        session.close()
+
+    batches, _ = generate_inventory(spec)
+    skus = sorted({batch.sku for batch in batches})
+    results = [
+        measure(f"SqlRepository.add [{label}]", add_batches),
+        measure(
+            f"SqlRepository.get [{label}]",
+            lambda: [lambda ref=batch.reference: read(lambda repo: repo.get(ref)) for batch in batches],
+        ),
+        measure(
+            f"SqlRepository.list(sku) [{label}]",
+            lambda: [lambda sku=sku: read(lambda repo: repo.list(sku)) for sku in skus],
+        ),
+        measure(f"SqlRepository.list [{label}]", lambda: [lambda: read(lambda repo: repo.list())]),
+    ]
+    results.extend(bench_get_loop(session_factory, [batch.reference for batch in batches], label))
+    engine.dispose()
+    return results
+
+
+def bench_get_loop(session_factory: sessionmaker, references: List[str], label: str) -> List[BenchmarkResult]:
+    """
+    `get` in a tight loop on one session, then its statement executed with and
+    without the compiled cache: the gap between the last two is the per-call
+    cost of compiling the SQL that reusing the prebuilt statement saves
+    """
+    session = session_factory()
+
+    def execute(options):
+        return lambda: [
+            lambda ref=ref: list(session.execute(respository.BATCH_BY_REFERENCE, dict(reference=ref), execution_options=options))
+            for ref in references
+        ]
+
+    results = [
+        measure(
+            f"get loop [{label}]",
+            lambda: [lambda ref=ref: respository.SqlRepository(session).get(ref) for ref in references],
+        ),
+        measure(f"get statement, compiled cache [{label}]", execute(dict())),
+        measure(f"get statement, no compiled cache [{label}]", execute(dict(compiled_cache=None))),
+    ]
+    session.close()
+    return results
+
+
+def run(spec: InventorySpec) -> List[BenchmarkResult]:
+    results = bench_model(spec)
+    results.extend(bench_bulk(spec))
+    results.extend(bench_repository(spec, "sqlite memory", "sqlite://"))
+    with tempfile.TemporaryDirectory() as directory:
+        results.extend(bench_repository(spec, "sqlite file", f"sqlite:///{os.path.join(directory, 'bench.db')}"))
+    return results
+
+
+def save_baseline(results: List[BenchmarkResult], path: str) -> None:
+    with open(path, "w") as f:
+        json.dump([asdict(result) for result in results], f, indent=2)
+
+
+def load_baseline(path: str) -> List[BenchmarkResult]:
+    with open(path) as f:
+        return [BenchmarkResult(**result) for result in json.load(f)]
+
+
+def compare(results: List[BenchmarkResult], baseline: List[BenchmarkResult], tolerance: float = 0.25) -> List[str]:
+    """Describe every benchmark whose throughput dropped by more than `tolerance` against the baseline"""
+    previous = {result.name: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result.name)
+        if before is not None and result.ops_per_sec < before.ops_per_sec * (1 - tolerance):
+            regressions.append(
+                f"{result.name}: {result.ops_per_sec:.0f} ops/s vs {before.ops_per_sec:.0f} ops/s in the baseline"
+            )
+    return regressions
+
+
+def format_results(results: List[BenchmarkResult]) -> str:
+    lines = [f"{'benchmark':<48} {'ops':>7} {'ops/s':>12} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>10}"]
+    for r in results:
+        lines.append(
+            f"{r.name:<48} {r.operations:>7} {r.ops_per_sec:>12.0f} {r.p50_ms:>9.3f} {r.p99_ms:>9.3f} {r.peak_memory_kb:>10.0f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--skus", type=int, default=InventorySpec.skus)
+    parser.add_argument("--batches-per-sku", type=int, default=InventorySpec.batches_per_sku)
+    parser.add_argument("--lines-per-batch", type=int, default=InventorySpec.lines_per_batch)
+    parser.add_argument("--eta-spread-days", type=int, default=InventorySpec.eta_spread_days)
+    parser.add_argument("--seed", type=int, default=InventorySpec.seed)
+    parser.add_argument("--save-baseline", metavar="PATH", help="write the results to PATH")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results with the baseline at PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed throughput drop against the baseline")
+    args = parser.parse_args(argv)
+
+    spec = InventorySpec(args.skus, args.batches_per_sku, args.lines_per_batch, args.eta_spread_days, args.seed)
+    results = run(spec)
+    print(format_results(results))
+
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline)
+    if args.compare:
+        regressions = compare(results, load_baseline(args.compare), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
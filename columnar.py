@@ -0,0 +1,118 @@
+from array import array
+from datetime import date
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import model
+
+
+# ETA ordinal given to warehouse stock: below any real date, so it is allocated from first
+WAREHOUSE_ETA = 0
+
+
+class ColumnarAllocator:
+    """
+    Allocation engine holding the whole inventory as flat columns instead of Batch objects.
+
+    Batches become rows sorted by (sku code, ETA ordinal, original position), so
+    each SKU occupies a contiguous slice of the `sku_codes`, `etas` and
+    `remaining` arrays. Lines are then allocated a SKU at a time against that
+    slice, which gives the same assignments as calling `model.allocate` for
+    each line in turn.
+    """
+
+    def __init__(self, batches: Iterable[model.Batch]):
+        batches = list(batches)
+        self._sku_codes: Dict[str, int] = {}
+        for batch in batches:
+            self._sku_codes.setdefault(batch.sku, len(self._sku_codes))
+
+        order = sorted(
+            range(len(batches)),
+            key=lambda i: (
+                self._sku_codes[batches[i].sku],
+                batches[i].eta.toordinal() if batches[i].eta is not None else WAREHOUSE_ETA,
+                i,
+            ),
+        )
+        self.references: List[str] = [batches[i].reference for i in order]
+        self.skus: List[str] = [batches[i].sku for i in order]
+        self.versions: List[Optional[int]] = [batches[i].version_number for i in order]
+        self.sku_codes = array("l", (self._sku_codes[batches[i].sku] for i in order))
+        self.etas = array("l", (batches[i].eta.toordinal() if batches[i].eta is not None else WAREHOUSE_ETA for i in order))
+        self.purchased = array("q", (batches[i]._purchased_quantity for i in order))
+        self.remaining = array("q", (batches[i].available_quantity for i in order))
+
+        # order lines held by each row, only for rows that have any
+        self._lines: Dict[int, Set[model.OrderLine]] = {
+            row: set(batches[i]._allocations) for row, i in enumerate(order) if batches[i]._allocations
+        }
+        self._assignments: List[Tuple[int, model.OrderLine]] = []
+
+        self._ranges: Dict[int, Tuple[int, int]] = {}
+        for row, code in enumerate(self.sku_codes):
+            start, _ = self._ranges.get(code, (row, row))
+            self._ranges[code] = (start, row + 1)
+
+    def allocate(self, lines: Iterable[model.OrderLine]) -> List[Optional[str]]:
+        """Allocate lines, returning the batch reference for each (or None when out of stock)"""
+        lines = list(lines)
+        results: List[Optional[str]] = [None] * len(lines)
+        positions_by_code: Dict[int, List[int]] = {}
+        for position, line in enumerate(lines):
+            code = self._sku_codes.get(line.sku)
+            if code is not None:
+                positions_by_code.setdefault(code, []).append(position)
+
+        for code, positions in positions_by_code.items():
+            start, stop = self._ranges[code]
+            remaining = self.remaining[start:stop].tolist() # work on a local copy of the SKU's slice
+            first = 0 # rows before this one are exhausted
+            for position in positions:
+                line = lines[position]
+                qty = line.qty
+                while first < len(remaining) and remaining[first] <= 0:
+                    first += 1
+                for offset in range(first if qty > 0 else 0, len(remaining)):
+                    if remaining[offset] >= qty:
+                        row = start + offset
+                        held = self._lines.setdefault(row, set())
+                        if line not in held: # allocations stay idempotent, as with Batch.allocate
+                            held.add(line)
+                            remaining[offset] -= qty
+                            self._assignments.append((row, line))
+                        results[position] = self.references[row]
+                        break
+            self.remaining[start:stop] = array("q", remaining)
+
+        return results
+
+    def assignments(self) -> List[Tuple[str, model.OrderLine]]:
+        """(batch reference, order line) pairs allocated by this engine, in allocation order"""
+        return [(self.references[row], line) for row, line in self._assignments]
+
+    def apply(self, batches: Iterable[model.Batch]) -> None:
+        """Allocate this engine's assignments onto the matching Batch objects"""
+        by_reference = {batch.reference: batch for batch in batches}
+        for reference, line in self.assignments():
+            by_reference[reference].allocate(line)
+
+    def to_batches(self) -> List[model.Batch]:
+        """Build Batch objects holding every allocation, e.g. to save with `SqlRepository.add_all`"""
+        batches = []
+        for row, reference in enumerate(self.references):
+            eta = self.etas[row]
+            batch = model.Batch(
+                reference,
+                self.skus[row],
+                self.purchased[row],
+                date.fromordinal(eta) if eta != WAREHOUSE_ETA else None,
+            )
+            batch.version_number = self.versions[row] # so saving it is checked against the version read
+            batch.restore_allocations(self._lines.get(row, ()))
+            batches.append(batch)
+        return batches
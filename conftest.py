@@ -14,4 +14,8 @@ def in_memory_db():
 
 @pytest.fixture
 def session(in_memory_db):
-    yield sessionmaker(bind=in_memory_db)()
\ No newline at end of file
+    yield sessionmaker(bind=in_memory_db)()
+
+@pytest.fixture
+def session_factory(in_memory_db):
+    yield sessionmaker(bind=in_memory_db)
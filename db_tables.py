@@ -16,9 +16,9 @@ order_lines = Table(
     "order_lines",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("sku", String(255)),
+    Column("sku", String(255), index=True),
     Column("qty", Integer, nullable=False),
-    Column("orderid", String(255)),
+    Column("orderid", String(255), index=True),
 )
 
 # Table for representing Batches
@@ -26,10 +26,14 @@ batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
-    Column("sku", String(255)),
+    Column("reference", String(255), unique=True, index=True),
+    Column("sku", String(255), index=True),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    # bumped on every change to the batch's allocations, for optimistic concurrency control
+    Column("version_number", Integer, nullable=False, server_default="0"),
+    # sum of the quantities of the allocated order lines, kept up to date by every write
+    Column("allocated_quantity", Integer, nullable=False, server_default="0"),
 )
 
 # Table for respresenting OrderLine Id <=0---0=> (m-to-m) Batch Id (intermediate table)
@@ -37,6 +41,18 @@ allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement= True),
-    Column("orderline_id", ForeignKey("order_lines.id")),
-    Column("batch_id", ForeignKey("batches.id")),
+    Column("orderline_id", ForeignKey("order_lines.id"), index=True),
+    Column("batch_id", ForeignKey("batches.id"), index=True),
+)
+
+# Append-only log of allocation events, in the order they were recorded
+allocation_events = Table(
+    "allocation_events",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("type", String(32), nullable=False),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255), nullable=True),
 )
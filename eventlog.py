@@ -0,0 +1,169 @@
+"""
+Append-only log of allocation events.
+
+Events are buffered in memory and written to a sink (the `allocation_events`
+table or a JSONL file) in bulk, one executemany or one file append per flush.
+`rebuild` replays a log onto batch definitions to reconstruct their allocations.
+"""
+import abc
+from dataclasses import asdict
+import json
+import os
+import threading
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Type
+
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from db_tables import allocation_events
+import events
+import model
+
+
+EVENT_TYPES: Dict[str, Type[events.Event]] = {
+    event_type.__name__: event_type for event_type in (events.Allocated, events.Deallocated, events.OutOfStock)
+}
+
+
+def to_record(event: events.Event) -> dict:
+    return dict(type=type(event).__name__, **asdict(event))
+
+def from_record(record: dict) -> events.Event:
+    return EVENT_TYPES[record["type"]](record["orderid"], record["sku"], record["qty"], record["batchref"])
+
+
+class EventSink(abc.ABC):
+    @abc.abstractmethod
+    def write(self, new_events: List[events.Event]) -> None:
+        """Append events in one bulk write"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self) -> Iterator[events.Event]:
+        """Stream every event appended so far, oldest first"""
+        raise NotImplementedError
+
+
+class SqlEventSink(EventSink):
+    """Events as rows of the `allocation_events` table, each write in its own transaction"""
+
+    INSERT = allocation_events.insert()
+    SELECT = select(
+        allocation_events.c.type,
+        allocation_events.c.orderid,
+        allocation_events.c.sku,
+        allocation_events.c.qty,
+        allocation_events.c.batchref,
+    ).order_by(allocation_events.c.id)
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def write(self, new_events: List[events.Event]) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(self.INSERT, [to_record(event) for event in new_events])
+
+    def read(self) -> Iterator[events.Event]:
+        with self.engine.connect() as connection:
+            for row in connection.execution_options(stream_results=True).execute(self.SELECT):
+                yield from_record(row._mapping)
+
+
+class JsonlEventSink(EventSink):
+    """Events as lines of a JSONL file, optionally fsynced after every write"""
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+
+    def write(self, new_events: List[events.Event]) -> None:
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(to_record(event)) + "\n" for event in new_events))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self) -> Iterator[events.Event]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    yield from_record(json.loads(line))
+
+
+class AllocationEventLog:
+    """
+    Buffer of events waiting to be appended to a sink.
+
+    The buffer is written out whenever it holds `buffer_size` events, on
+    `flush` and when leaving a `with` block. A failed write keeps the events
+    buffered, so a later flush retries them.
+    """
+
+    def __init__(self, sink: EventSink, buffer_size: int = 1000):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self._buffer: List[events.Event] = []
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "AllocationEventLog":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.flush()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def record(self, new_events: Iterable[events.Event]) -> None:
+        with self._lock:
+            self._buffer.extend(new_events)
+            full = len(self._buffer) >= self.buffer_size
+        if full:
+            self.flush()
+
+    def collect(self, batches: Iterable[model.Batch]) -> None:
+        """Record the events raised by each batch, emptying its `events`"""
+        for batch in batches:
+            if batch.events:
+                self.record(batch.events)
+                batch.events.clear()
+
+    def flush(self) -> int:
+        """Append every buffered event to the sink, returning how many were written"""
+        with self._lock:
+            written = self._buffer
+            if written:
+                self.sink.write(written)
+            self._buffer = []
+        return len(written)
+
+
+def rebuild(batches: Iterable[model.Batch], log: Iterable[events.Event]) -> List[model.Batch]:
+    """
+    Replay allocation events onto batches, returning them in the order given.
+
+    The batches are usually fresh definitions without allocations. Events for
+    other batches are skipped, so a subset (e.g. one SKU) can be rebuilt from
+    the whole log.
+    """
+    batches = list(batches)
+    by_reference = {batch.reference: batch for batch in batches}
+    for event in log:
+        batch = by_reference.get(event.batchref)
+        if batch is None:
+            continue
+        if isinstance(event, events.Allocated):
+            batch.allocate(model.OrderLine(event.orderid, event.sku, event.qty))
+        elif isinstance(event, events.Deallocated):
+            batch.deallocate(model.OrderLine(event.orderid, event.sku, event.qty))
+    for batch in batches:
+        if batch.events:
+            batch.events.clear() # replayed history, not new events
+    return batches
@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+class Event:
+    """Something that happened to the allocations, recorded in the order it happened"""
+
+
+@dataclass(frozen=True)
+class Allocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass(frozen=True)
+class Deallocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass(frozen=True)
+class OutOfStock(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: Optional[str] = None # never set: no batch could take the line
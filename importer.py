@@ -0,0 +1,344 @@
+"""
+Streaming bulk import of batches and allocations from CSV or JSONL files.
+
+Batch files have `reference`, `sku`, `qty` and `eta` (ISO date, or empty for
+warehouse stock) fields. Allocation files have `orderid`, `sku`, `qty` and
+`batch` (the batch reference) fields. Rows are validated and written in
+chunks of `chunk_size`, each chunk in its own transaction. Batches whose
+reference is already stored, and allocation rows that repeat one already in
+the file or the database, are skipped, so an import can be run again safely.
+"""
+import argparse
+from collections import defaultdict
+import csv
+from dataclasses import dataclass
+from dataclasses import replace
+from datetime import date
+from functools import partial
+import json
+import sys
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from sqlalchemy import bindparam
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from db_tables import allocations as allocations_table
+from db_tables import batches as batches_table
+from db_tables import metadata
+from db_tables import order_lines as order_lines_table
+import model
+from respository import IN_CLAUSE_CHUNK_SIZE
+from respository import INSERT_ALLOCATIONS
+from respository import INSERT_BATCHES
+from respository import insert_order_lines
+import unit_of_work
+
+
+# statements the repository has no use for, built once like its own
+batch_cols = batches_table.c
+line_cols = order_lines_table.c
+allocation_cols = allocations_table.c
+
+STORED_REFERENCES = select(batch_cols.reference).where(batch_cols.reference.in_(bindparam("references", expanding=True)))
+BATCH_STOCK = select(
+    batch_cols.id,
+    batch_cols.reference,
+    batch_cols.sku,
+    (batch_cols._purchased_quantity - batch_cols.allocated_quantity).label("available"),
+).where(batch_cols.reference.in_(bindparam("references", expanding=True)))
+ALLOCATED_FOR_ORDERS = (
+    select(allocation_cols.batch_id, line_cols.orderid, line_cols.sku, line_cols.qty)
+    .join_from(order_lines_table, allocations_table, allocation_cols.orderline_id == line_cols.id)
+    .where(line_cols.orderid.in_(bindparam("orderids", expanding=True)))
+)
+# bind names differ from the column names, which SQLAlchemy reserves for the SET clause
+ADD_ALLOCATED_QUANTITY = (
+    batches_table.update()
+    .where(batch_cols.id == bindparam("batch_id"))
+    .values(
+        allocated_quantity=batch_cols.allocated_quantity + bindparam("added_quantity"),
+        version_number=batch_cols.version_number + 1,
+    )
+)
+
+
+class InvalidRow(ValueError):
+    """Raised for a row that cannot be imported, naming the file and line it came from"""
+
+    def __init__(self, path: str, line_number: int, reason: str):
+        super().__init__(f"{path}:{line_number}: {reason}")
+        self.path = path
+        self.line_number = line_number
+        self.reason = reason
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    skipped: int = 0 # rows (among `rows`) that repeated a batch or an allocation already imported
+    chunks: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def read_rows(path: str) -> Iterator[Tuple[int, dict]]:
+    """Stream (line number, row) pairs from a .csv or .jsonl file"""
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        elif path.endswith((".jsonl", ".ndjson")):
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except json.JSONDecodeError as e:
+                        raise InvalidRow(path, line_number, f"invalid JSON: {e.msg}")
+        else:
+            raise ValueError(f"Cannot tell the format of {path}: expected a .csv or .jsonl file")
+
+
+def _field(path: str, line_number: int, row: dict, name: str) -> str:
+    value = row.get(name)
+    if value is None or str(value).strip() == "":
+        raise InvalidRow(path, line_number, f"missing `{name}`")
+    return str(value).strip()
+
+def _quantity(path: str, line_number: int, row: dict, minimum: int) -> int:
+    value = _field(path, line_number, row, "qty")
+    try:
+        qty = int(value)
+    except ValueError:
+        raise InvalidRow(path, line_number, f"`qty` is not a whole number: {value!r}")
+    if qty < minimum:
+        raise InvalidRow(path, line_number, f"`qty` must be at least {minimum}: {qty}")
+    return qty
+
+def _eta(path: str, line_number: int, row: dict) -> Optional[date]:
+    value = row.get("eta")
+    if value is None or str(value).strip() in ("", "null", "None"):
+        return None
+    try:
+        return date.fromisoformat(str(value).strip())
+    except ValueError:
+        raise InvalidRow(path, line_number, f"`eta` is not an ISO date: {value!r}")
+
+
+def _chunked(rows: Iterator, chunk_size: int) -> Iterator[List]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _run(
+    session_factory: sessionmaker,
+    path: str,
+    chunk_size: int,
+    write_chunk: Callable,
+    progress: Optional[Callable[[ImportReport], None]],
+) -> ImportReport:
+    report = ImportReport()
+    started = time.perf_counter()
+    session = session_factory()
+    try:
+        for chunk in _chunked(read_rows(path), chunk_size):
+            report.skipped += write_chunk(session, path, chunk)
+            session.commit()
+            report.rows += len(chunk)
+            report.chunks += 1
+            report.seconds = time.perf_counter() - started
+            if progress is not None:
+                progress(replace(report)) # a copy, since the report keeps changing
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def import_batches(
+    session_factory: sessionmaker,
+    path: str,
+    chunk_size: int = 10_000,
+    progress: Optional[Callable[[ImportReport], None]] = None,
+) -> ImportReport:
+    """
+    Load batches from `path`, one executemany and one transaction per chunk.
+
+    A row that fails validation, or repeats a reference from earlier in the file,
+    raises InvalidRow; chunks before it stay committed. A row whose reference is
+    already stored is skipped and counted in the report's `skipped`.
+    """
+    write_chunk = partial(_write_batches, first_lines={})
+    return _run(session_factory, path, chunk_size, write_chunk, progress)
+
+
+def _write_batches(session, path: str, chunk: List[Tuple[int, dict]], first_lines: Dict[str, int]) -> int:
+    """
+    Write a chunk of batch rows, returning how many were skipped as already stored.
+    `first_lines` maps each reference seen so far in the file to its line number.
+    """
+    params = []
+    for line_number, row in chunk:
+        reference = _field(path, line_number, row, "reference")
+        if reference in first_lines:
+            raise InvalidRow(path, line_number, f"batch `{reference}` is already on line {first_lines[reference]}")
+        first_lines[reference] = line_number
+        params.append(dict(
+            reference=reference,
+            sku=_field(path, line_number, row, "sku"),
+            _purchased_quantity=_quantity(path, line_number, row, minimum=0),
+            eta=_eta(path, line_number, row),
+        ))
+
+    stored = set()
+    references = [batch["reference"] for batch in params]
+    for start in range(0, len(references), IN_CLAUSE_CHUNK_SIZE):
+        rows = session.execute(STORED_REFERENCES, dict(references=references[start:start + IN_CLAUSE_CHUNK_SIZE]))
+        stored.update(reference for reference, in rows)
+    new = [batch for batch in params if batch["reference"] not in stored]
+    if new:
+        session.execute(INSERT_BATCHES, new)
+    return len(params) - len(new)
+
+
+def import_allocations(
+    session_factory: sessionmaker,
+    path: str,
+    chunk_size: int = 10_000,
+    progress: Optional[Callable[[ImportReport], None]] = None,
+) -> ImportReport:
+    """
+    Load allocations from `path` onto batches that already exist, one transaction per chunk.
+
+    Besides the field checks, a row is rejected (with InvalidRow) if its batch
+    does not exist, holds another SKU, or has too little stock left for it.
+    A row allocating the same (batch, orderid, sku, qty) as an earlier row or
+    an allocation already stored is skipped and counted in the report's `skipped`.
+    """
+    return _run(session_factory, path, chunk_size, _write_allocations, progress)
+
+
+def _write_allocations(session, path: str, chunk: List[Tuple[int, dict]]) -> int:
+    """Write a chunk of allocation rows, returning how many were skipped as duplicates"""
+    rows = [
+        (
+            line_number,
+            _field(path, line_number, row, "batch"),
+            _field(path, line_number, row, "orderid"),
+            _field(path, line_number, row, "sku"),
+            _quantity(path, line_number, row, minimum=1),
+        )
+        for line_number, row in chunk
+    ]
+    batches = _load_batch_stock(session, sorted({reference for _, reference, _, _, _ in rows}))
+    allocated = _load_allocated(session, sorted({orderid for _, _, orderid, _, _ in rows}))
+
+    lines = []
+    for line_number, reference, orderid, sku, qty in rows:
+        if reference not in batches:
+            raise InvalidRow(path, line_number, f"unknown batch `{reference}`")
+        batch = batches[reference]
+        if batch["sku"] != sku:
+            raise InvalidRow(path, line_number, f"batch `{reference}` holds `{batch['sku']}`, not `{sku}`")
+        key = (batch["id"], orderid, sku, qty)
+        if key in allocated: # already stored, or earlier in the file
+            continue
+        if batch["available"] < qty:
+            raise InvalidRow(path, line_number, f"batch `{reference}` has only {batch['available']} left")
+        batch["available"] -= qty
+        allocated.add(key)
+        lines.append((line_number, reference, orderid, sku, qty))
+    if not lines:
+        return len(rows)
+
+    orderline_ids = insert_order_lines(
+        session.execute,
+        session.get_bind().dialect,
+        [model.OrderLine(orderid, sku, qty) for _, _, orderid, sku, qty in lines],
+    )
+    session.execute(
+        INSERT_ALLOCATIONS,
+        [
+            dict(orderline_id=orderline_id, batch_id=batches[reference]["id"])
+            for (_, reference, _, _, _), orderline_id in zip(lines, orderline_ids)
+        ],
+    )
+
+    # keep the stored totals in step, bumping versions so concurrent repository writers notice
+    allocated_quantities = defaultdict(int)
+    for _, reference, _, _, qty in lines:
+        allocated_quantities[batches[reference]["id"]] += qty
+    session.execute(
+        ADD_ALLOCATED_QUANTITY,
+        [dict(batch_id=batch_id, added_quantity=qty) for batch_id, qty in allocated_quantities.items()],
+    )
+    return len(rows) - len(lines)
+
+
+def _load_batch_stock(session, references: List[str]) -> Dict[str, dict]:
+    """Id, SKU and quantity still available for each existing batch in `references`"""
+    batches = {}
+    for start in range(0, len(references), IN_CLAUSE_CHUNK_SIZE):
+        rows = session.execute(BATCH_STOCK, dict(references=references[start:start + IN_CLAUSE_CHUNK_SIZE]))
+        batches.update({row.reference: dict(id=row.id, sku=row.sku, available=row.available) for row in rows})
+    return batches
+
+
+def _load_allocated(session, orderids: List[str]) -> Set[Tuple[int, str, str, int]]:
+    """(batch id, orderid, sku, qty) of every allocation already stored for `orderids`"""
+    allocated = set()
+    for start in range(0, len(orderids), IN_CLAUSE_CHUNK_SIZE):
+        rows = session.execute(ALLOCATED_FOR_ORDERS, dict(orderids=orderids[start:start + IN_CLAUSE_CHUNK_SIZE]))
+        allocated.update((row.batch_id, row.orderid, row.sku, row.qty) for row in rows)
+    return allocated
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("kind", choices=["batches", "allocations"])
+    parser.add_argument("path")
+    parser.add_argument("--database-url", default="sqlite:///allocation.db")
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    args = parser.parse_args(argv)
+
+    engine = unit_of_work.create_engine_from_config(args.database_url)
+    metadata.create_all(engine) # only creates the tables that are missing
+    session_factory = sessionmaker(bind=engine)
+    load = import_batches if args.kind == "batches" else import_allocations
+
+    def progress(report: ImportReport) -> None:
+        print(f"{report.rows} rows in {report.seconds:.1f}s ({report.rows_per_second:.0f} rows/s)", file=sys.stderr)
+
+    try:
+        report = load(session_factory, args.path, args.chunk_size, progress)
+    except InvalidRow as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    print(f"imported {report.rows} {args.kind} in {report.seconds:.1f}s ({report.rows_per_second:.0f} rows/s)")
+    if report.skipped:
+        print(f"skipped {report.skipped} rows that were already imported")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
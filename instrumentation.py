@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+import functools
+import inspect
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+
+
+@dataclass
+class CallStats:
+    """What a single repository call cost"""
+    method: str
+    statements: int = 0
+    rows_read: int = 0
+    rows_written: int = 0
+    wall_time: float = 0.0
+    hydration_time: float = 0.0 # spent building model.Batch / model.OrderLine objects
+
+
+class RepositoryMetrics:
+    """
+    Opt-in sink for the CallStats of every instrumented repository call.
+
+    Each call's stats are passed to the callbacks (e.g. to export them to a
+    monitoring system) and added to per-method totals available from `totals`.
+    """
+
+    def __init__(self, callbacks: Iterable[Callable[[CallStats], None]] = ()):
+        self.callbacks = list(callbacks)
+        self.calls: Dict[str, int] = {}
+        self.totals: Dict[str, CallStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stats: CallStats) -> None:
+        with self._lock:
+            self.calls[stats.method] = self.calls.get(stats.method, 0) + 1
+            total = self.totals.setdefault(stats.method, CallStats(stats.method))
+            total.statements += stats.statements
+            total.rows_read += stats.rows_read
+            total.rows_written += stats.rows_written
+            total.wall_time += stats.wall_time
+            total.hydration_time += stats.hydration_time
+        for callback in self.callbacks:
+            callback(stats)
+
+
+@contextmanager
+def collecting(owner, stats: CallStats) -> Iterator[CallStats]:
+    """Make `stats` the owner's active stats for the duration of the block, timing it"""
+    previous, owner._stats = owner._stats, stats
+    started = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall_time += time.perf_counter() - started
+        owner._stats = previous
+
+
+def instrumented(method):
+    """
+    Record the cost of a public repository method when the repository has `metrics`.
+
+    Only the outermost instrumented call is recorded: statements issued by
+    nested calls (e.g. `add` delegating to `add_all`) count towards it. For
+    generator methods only the time spent producing items is counted, not the
+    time the caller spends between them.
+    """
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            if self.metrics is None or self._stats is not None:
+                yield from method(self, *args, **kwargs)
+                return
+            stats = CallStats(method.__name__)
+            items = method(self, *args, **kwargs)
+            try:
+                while True:
+                    with collecting(self, stats):
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                    yield item
+            finally:
+                self.metrics.record(stats)
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.metrics is None or self._stats is not None:
+            return method(self, *args, **kwargs)
+        stats = CallStats(method.__name__)
+        try:
+            with collecting(self, stats):
+                return method(self, *args, **kwargs)
+        finally:
+            self.metrics.record(stats)
+    return wrapper
+
@@ -1,28 +1,76 @@
+import bisect
 from dataclasses import dataclass
 from datetime import date
+from typing import Callable
+from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
 from typing import Set
+from typing import Tuple
 
+import events
 
-@dataclass(unsafe_hash=True)
+
+@dataclass(frozen=True)
 class OrderLine:
     """Represents Order Line entity within an Order entity"""
+    __slots__ = ("orderid", "sku", "qty") # no per-instance __dict__: millions of lines get hydrated at once
     orderid: str
     sku: str
     qty: int
 
+    def __reduce__(self):
+        """Pickle through the constructor, since frozen slotted instances cannot have their state set"""
+        return (OrderLine, (self.orderid, self.sku, self.qty))
+
 class Batch:
+    __slots__ = (
+        "reference", "sku", "eta", "_purchased_quantity", "_lines", "_allocated_quantity", "_loader", "version_number", "events"
+    )
+
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
         self.reference = ref
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
-        self._allocations: Set[OrderLine] = set() # sets give us idempotent allocations for free
+        self._lines: Set[OrderLine] = set() # sets give us idempotent allocations for free
+        self._allocated_quantity = 0 # running total kept in step with _allocations
+        self._loader: Optional[Callable[[], Iterable[OrderLine]]] = None
+        self.version_number: Optional[int] = None # stored version it was read at, None if never stored
+        self.events: Optional[List[events.Event]] = None # what happened since they were last collected, once recording
+
+    def record_events(self) -> None:
+        """Start keeping the events raised by allocate and deallocate, for whoever collects them"""
+        if self.events is None:
+            self.events = []
+
+    def defer_allocations(self, loader: Callable[[], Iterable[OrderLine]], allocated_quantity: int) -> None:
+        """
+        Fetch the allocated order lines with `loader` only when they are first needed,
+        reporting `allocated_quantity` (e.g. a stored total) until then
+        """
+        self._loader = loader
+        self._allocated_quantity = allocated_quantity
+
+    def restore_allocations(self, lines: Iterable[OrderLine]) -> None:
+        """
+        Replace the allocations with `lines` as they were stored, without checking
+        them against the purchased quantity (they are already allocated) or raising events
+        """
+        self._loader = None
+        self._lines = set(lines)
+        self._allocated_quantity = sum(line.qty for line in self._lines)
+
+    @property
+    def _allocations(self) -> Set[OrderLine]:
+        if self._loader is not None:
+            self.restore_allocations(self._loader())
+        return self._lines
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -30,16 +78,26 @@ class Batch:
 
     def allocate(self, line: OrderLine) -> None:
         """Allocate an OrderLine to a Batch"""
-        if self.can_allocate(line):
-            self._allocations.add(line)
+        if self.can_allocate(line) and line not in self._allocations:
+            self._lines.add(line)
+            self._allocated_quantity += line.qty
+            if self.events is not None:
+                self.events.append(events.Allocated(line.orderid, line.sku, line.qty, self.reference))
 
     def deallocate(self, line: OrderLine) -> None:
         if line in self._allocations:
-            self._allocations.remove(line)
+            self._lines.remove(line)
+            self._allocated_quantity -= line.qty
+            if self.events is not None:
+                self.events.append(events.Deallocated(line.orderid, line.sku, line.qty, self.reference))
         
     def can_allocate(self, line: OrderLine) -> bool:
         """Helper function for checking SKUs match and enough available quantity"""
-        return self.sku == line.sku and self.available_quantity >= line.qty
+        if self.sku != line.sku:
+            return False
+        if self._loader is not None:
+            self._allocations # a deferred total may be stale: decide on the loaded lines
+        return self.available_quantity >= line.qty
 
     def __eq__(self, other: object) -> bool:
         """Special method required to define referential equality of two Batch entities."""
@@ -58,6 +116,14 @@ class Batch:
     def __hash__(self) -> int:
         return hash(self.reference)
 
+    def __getstate__(self):
+        """
+        Pickle with the allocations loaded, as the loader usually holds a database session.
+        Events stay with the instance that raised them, so copies start without any.
+        """
+        self._allocations
+        return None, {slot: getattr(self, slot) if slot != "events" else None for slot in self.__slots__}
+
     def __repr__(self) -> str:
         return f"BATCH. reference: {self.reference}, sku: {self.sku}, eta: {self.eta}, qty: {self._purchased_quantity}, allocations: {self._allocations}."
 
@@ -77,4 +143,178 @@ def allocate(line: OrderLine, batches: List[Batch]) -> str:
         batch.allocate(line)
         return batch.reference
     except StopIteration:
-        raise OutOfStock(f"The SKU `{line.sku}` is out of stock")
\ No newline at end of file
+        raise OutOfStock(f"The SKU `{line.sku}` is out of stock")
+
+
+class AllocationIndex:
+    """Batches grouped by SKU, each group kept in allocation order.
+
+    Built once over a collection of batches so that allocating many order lines
+    does not re-sort every batch per line: only the batches sharing the line's
+    SKU are scanned, and they are already ordered warehouse stock first, then by
+    earliest ETA (the same ordering as `Batch.__gt__`).
+
+    It also maps each order id to the batches holding its lines, so an order can
+    be deallocated without searching every batch. Lines allocated directly with
+    `Batch.allocate` after a batch was added are not in that map.
+
+    Batches can be added, removed or have their ETA changed (e.g. a shipment
+    arriving) while the index is in use: each finds its position with a binary
+    search of its SKU's sort keys instead of re-sorting the group.
+    """
+
+    def __init__(self, batches: Iterable[Batch] = ()):
+        self._batches: Dict[str, List[Batch]] = {}
+        self._keys: Dict[str, List[Tuple[bool, date, int]]] = {}
+        self._sequence = 0 # tie-breaker so equal ETAs keep insertion order, like sorted()
+        self._located: Dict[str, Tuple[str, Tuple[bool, date, int]]] = {} # batch reference -> (sku, sort key)
+        self._orders: Dict[str, List[Tuple[Batch, OrderLine]]] = {} # orderid -> where its lines are allocated
+        for batch in batches:
+            self.add(batch)
+
+    def add(self, batch: Batch) -> None:
+        """Insert a batch into its SKU group at its ETA position"""
+        if batch.reference in self._located:
+            raise ValueError(f"Batch `{batch.reference}` is already indexed")
+        self._insert(batch, self._sequence)
+        self._sequence += 1
+        for line in batch._allocations:
+            held = self._orders.setdefault(line.orderid, [])
+            if (batch, line) not in held: # still known if the batch was removed and is added back
+                held.append((batch, line))
+
+    def remove(self, reference: str) -> Batch:
+        """
+        Take a batch (e.g. an exhausted one) out of its SKU group, returning it.
+        Its allocations stay known, so their orders can still be deallocated.
+        """
+        return self._take(reference)
+
+    def update_eta(self, reference: str, eta: Optional[date]) -> Batch:
+        """Change a batch's ETA (None once it has arrived) and move it to its new position"""
+        _, (_, _, sequence) = self._located[reference] # keep its place among batches with the same ETA
+        batch = self._take(reference)
+        batch.eta = eta
+        self._insert(batch, sequence)
+        return batch
+
+    def change_quantity(self, reference: str, qty: int) -> List[OrderLine]:
+        """
+        Change a batch's purchased quantity. If it no longer covers the batch's
+        allocations, lines are deallocated until it does and returned, to be
+        allocated again (for instance with `allocate_many`). Lines go in
+        descending order of order id, so the outcome does not depend on set ordering.
+        """
+        batch = self._batch(reference)
+        batch._purchased_quantity = qty
+        deallocated = []
+        by_orderid = sorted(batch._allocations, key=lambda line: (line.orderid, line.sku, line.qty), reverse=True)
+        for line in by_orderid:
+            if batch.available_quantity >= 0:
+                break
+            batch.deallocate(line)
+            held = self._orders.get(line.orderid, [])
+            if (batch, line) in held:
+                held.remove((batch, line))
+                if not held:
+                    del self._orders[line.orderid]
+            deallocated.append(line)
+        return deallocated
+
+    def batches_for(self, sku: str) -> List[Batch]:
+        """Batches holding `sku`, in the order they are allocated from"""
+        return list(self._batches.get(sku, ()))
+
+    def allocate(self, line: OrderLine) -> str:
+        """Allocate an Order Line following the same business rules as `allocate`"""
+        for batch in self._batches.get(line.sku, ()):
+            if batch.can_allocate(line):
+                self._allocate_to(batch, line)
+                return batch.reference
+        raise OutOfStock(f"The SKU `{line.sku}` is out of stock")
+
+    def allocate_many(self, lines: Iterable[OrderLine]) -> List[Optional[str]]:
+        """Allocate many Order Lines, returning a batch reference (or None when out of stock) per line.
+
+        Lines are grouped by SKU and each group is allocated in its original order
+        against that SKU's batches, which gives the same result as allocating the
+        lines one at a time since SKUs never compete for the same batch.
+        """
+        lines = list(lines)
+        results: List[Optional[str]] = [None] * len(lines)
+        positions_by_sku: Dict[str, List[int]] = {}
+        for position, line in enumerate(lines):
+            positions_by_sku.setdefault(line.sku, []).append(position)
+
+        for sku, positions in positions_by_sku.items():
+            batches = self._batches.get(sku, ())
+            first = 0 # batches before this one are exhausted and can be skipped
+            for position in positions:
+                line = lines[position]
+                while first < len(batches) and batches[first].available_quantity <= 0:
+                    first += 1
+                for i in range(first if line.qty > 0 else 0, len(batches)):
+                    batch = batches[i]
+                    if batch.can_allocate(line):
+                        self._allocate_to(batch, line)
+                        results[position] = batch.reference
+                        break
+
+        return results
+
+    def orders_for(self, orderid: str) -> List[str]:
+        """References of the batches holding lines of `orderid`"""
+        return sorted({batch.reference for batch, _ in self._orders.get(orderid, ())})
+
+    def deallocate(self, orderid: str) -> List[OrderLine]:
+        """Remove every line of `orderid` from the batches holding it, returning those lines"""
+        lines = []
+        for batch, line in self._orders.pop(orderid, ()):
+            batch.deallocate(line)
+            lines.append(line)
+        return lines
+
+    def reallocate(self, orderid: str) -> List[Optional[str]]:
+        """
+        Deallocate `orderid` and allocate its lines again, e.g. after a batch's ETA changed.
+
+        Returns a batch reference (or None when out of stock) per line, as `allocate_many` does.
+        """
+        return self.allocate_many(self.deallocate(orderid))
+
+    def _insert(self, batch: Batch, sequence: int) -> None:
+        key = (batch.eta is not None, batch.eta or date.min, sequence)
+        keys = self._keys.setdefault(batch.sku, [])
+        position = bisect.bisect(keys, key)
+        keys.insert(position, key)
+        self._batches.setdefault(batch.sku, []).insert(position, batch)
+        self._located[batch.reference] = (batch.sku, key)
+
+    def _position(self, reference: str) -> Tuple[str, int]:
+        """The SKU group and position of a batch, found by binary search on its key"""
+        sku, key = self._located[reference]
+        return sku, bisect.bisect_left(self._keys[sku], key)
+
+    def _batch(self, reference: str) -> Batch:
+        sku, position = self._position(reference)
+        return self._batches[sku][position]
+
+    def _take(self, reference: str) -> Batch:
+        sku, position = self._position(reference)
+        del self._keys[sku][position]
+        del self._located[reference]
+        return self._batches[sku].pop(position)
+
+    def _allocate_to(self, batch: Batch, line: OrderLine) -> None:
+        if line not in batch._allocations: # re-allocating the same line is a no-op, so index it once
+            batch.allocate(line)
+            self._orders.setdefault(line.orderid, []).append((batch, line))
+
+
+def allocate_many(lines: Iterable[OrderLine], batches: Iterable[Batch]) -> List[Optional[str]]:
+    """Allocate many Order Lines given Batches, without raising when one is out of stock.
+
+    Returns the allocated batch reference for each line, in the same order as
+    `lines`, or None for lines that could not be allocated.
+    """
+    return AllocationIndex(batches).allocate_many(lines)
@@ -0,0 +1,92 @@
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import events
+import model
+
+
+Shard = Tuple[List[model.Batch], List[model.OrderLine]]
+
+
+def _allocate_shard(shard: Shard) -> Dict[str, List[int]]:
+    """
+    Runs in a worker process: allocate a shard's lines against its own copy of the
+    batches, returning the positions (within the shard) of the lines each batch took
+    """
+    batches, lines = shard
+    taken: Dict[str, List[int]] = {}
+    for position, reference in enumerate(model.allocate_many(lines, batches)):
+        if reference is not None:
+            taken.setdefault(reference, []).append(position)
+    return taken
+
+
+def _swap_in(batch: model.Batch, lines: List[model.OrderLine]) -> None:
+    """Add the lines a worker allocated to a batch in one go, raising the events it would have raised itself"""
+    added = [line for line in dict.fromkeys(lines) if line not in batch._allocations]
+    if batch.events is not None:
+        batch.events.extend(events.Allocated(line.orderid, line.sku, line.qty, batch.reference) for line in added)
+    batch.restore_allocations(batch._allocations.union(added))
+
+
+def make_shards(lines: List[model.OrderLine], batches: List[model.Batch], shard_count: int) -> List[Tuple[List[int], Shard]]:
+    """
+    Split lines and batches into at most `shard_count` shards that never share a SKU.
+
+    SKUs are assigned largest first (by number of lines, then by name) to the
+    least loaded shard, so the split is deterministic and roughly balanced.
+    Each shard comes with the positions of its lines in `lines`.
+    """
+    positions_by_sku: Dict[str, List[int]] = {}
+    for position, line in enumerate(lines):
+        positions_by_sku.setdefault(line.sku, []).append(position)
+    batches_by_sku: Dict[str, List[model.Batch]] = {}
+    for batch in batches:
+        if batch.sku in positions_by_sku: # batches nobody orders from are never looked at
+            batches_by_sku.setdefault(batch.sku, []).append(batch)
+
+    shards = [([], ([], [])) for _ in range(max(1, min(shard_count, len(positions_by_sku))))]
+    for sku in sorted(positions_by_sku, key=lambda sku: (-len(positions_by_sku[sku]), sku)):
+        positions, (shard_batches, shard_lines) = min(shards, key=lambda shard: len(shard[0]))
+        positions.extend(positions_by_sku[sku])
+        shard_batches.extend(batches_by_sku.get(sku, ()))
+        shard_lines.extend(lines[position] for position in positions_by_sku[sku])
+    return [shard for shard in shards if shard[0]]
+
+
+def allocate_in_parallel(
+    lines: Iterable[model.OrderLine],
+    batches: Iterable[model.Batch],
+    max_workers: Optional[int] = None,
+    executor_factory: Callable[[int], Executor] = ProcessPoolExecutor,
+) -> List[Optional[str]]:
+    """
+    Allocate many Order Lines across a pool of worker processes, one shard of SKUs per worker.
+
+    SKUs never compete for the same batch, so each shard is allocated
+    independently with `model.allocate_many`. Workers send back which lines
+    each batch took (as positions, so no order lines are pickled back), and
+    each batch gets those lines added at once without checking them again,
+    giving the same outcome as `model.allocate_many(lines, batches)`.
+    """
+    lines, batches = list(lines), list(batches)
+    max_workers = max_workers or os.cpu_count() or 1
+    shards = make_shards(lines, batches, max_workers)
+
+    by_reference = {batch.reference: batch for batch in batches}
+    results: List[Optional[str]] = [None] * len(lines)
+    with executor_factory(max_workers) as executor:
+        shard_results = executor.map(_allocate_shard, [shard for _, shard in shards])
+        for (positions, (_, shard_lines)), taken in zip(shards, shard_results):
+            for reference, shard_positions in taken.items():
+                for shard_position in shard_positions:
+                    results[positions[shard_position]] = reference
+                _swap_in(by_reference[reference], [shard_lines[shard_position] for shard_position in shard_positions])
+    return results
@@ -1,11 +1,163 @@
 import abc
+from collections import defaultdict
+from collections import deque
+from collections import OrderedDict
+from datetime import date
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Set
+from typing import Tuple
 
+from sqlalchemy import bindparam
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.engine import Dialect
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
+from db_tables import allocations as allocations_table
+from db_tables import batches as batches_table
+from db_tables import order_lines as order_lines_table
+import events
+from instrumentation import CallStats
+from instrumentation import instrumented
+from instrumentation import RepositoryMetrics
 import model
 
 
+# keep IN (...) lists well below the bound parameter limits of the database
+IN_CLAUSE_CHUNK_SIZE = 500
+
+
+# Every statement is built once, here, as a Core construct with named bind
+# parameters: each call then only binds new values and SQLAlchemy reuses the
+# compiled SQL from the engine's compiled cache instead of compiling it again.
+batch_cols = batches_table.c
+line_cols = order_lines_table.c
+allocation_cols = allocations_table.c
+
+# batches LEFT JOINed to their allocated order lines, ordered so each batch's rows are contiguous
+BATCHES_WITH_LINES = (
+    select(
+        batch_cols.id,
+        batch_cols.reference,
+        batch_cols.sku,
+        batch_cols.eta,
+        batch_cols._purchased_quantity,
+        batch_cols.version_number,
+        line_cols.id.label("orderline_id"),
+        line_cols.orderid,
+        line_cols.sku.label("line_sku"),
+        line_cols.qty,
+    )
+    .select_from(
+        batches_table
+        .outerjoin(allocations_table, batch_cols.id == allocation_cols.batch_id)
+        .outerjoin(order_lines_table, allocation_cols.orderline_id == line_cols.id)
+    )
+    .order_by(batch_cols.id)
+)
+BATCHES_WITH_LINES_FOR_SKU = BATCHES_WITH_LINES.where(batch_cols.sku == bindparam("sku"))
+BATCHES_WITH_LINES_FOR_ORDER = BATCHES_WITH_LINES.where(
+    batch_cols.id.in_(
+        select(allocation_cols.batch_id)
+        .join_from(order_lines_table, allocations_table, allocation_cols.orderline_id == line_cols.id)
+        .where(line_cols.orderid == bindparam("orderid"))
+    )
+)
+BATCHES_WITH_LINES_FOR_REFERENCES = BATCHES_WITH_LINES.where(
+    batch_cols.reference.in_(bindparam("references", expanding=True))
+)
+BATCHES_WITH_LINES_IN_ID_RANGE = BATCHES_WITH_LINES.where(
+    batch_cols.id > bindparam("last_id"), batch_cols.id <= bindparam("chunk_last_id")
+)
+BATCHES_WITH_LINES_FOR_SKU_IN_ID_RANGE = BATCHES_WITH_LINES_IN_ID_RANGE.where(batch_cols.sku == bindparam("sku"))
+
+BATCH_IDS_PAGE = (
+    select(batch_cols.id)
+    .where(batch_cols.id > bindparam("last_id"))
+    .order_by(batch_cols.id)
+    .limit(bindparam("chunk_size"))
+)
+BATCH_IDS_PAGE_FOR_SKU = BATCH_IDS_PAGE.where(batch_cols.sku == bindparam("sku"))
+
+BATCH_BY_REFERENCE = select(
+    batch_cols.id,
+    batch_cols.reference,
+    batch_cols.sku,
+    batch_cols.eta,
+    batch_cols._purchased_quantity,
+    batch_cols.version_number,
+    batch_cols.allocated_quantity,
+).where(batch_cols.reference == bindparam("reference"))
+BATCH_VERSIONS_BY_REFERENCES = select(batch_cols.id, batch_cols.reference, batch_cols.version_number).where(
+    batch_cols.reference.in_(bindparam("references", expanding=True))
+)
+INSERT_BATCHES = batches_table.insert()
+# bind names differ from the column names, which SQLAlchemy reserves for the SET clause
+BUMP_BATCH_VERSION = (
+    batches_table.update()
+    .where(batch_cols.id == bindparam("batch_id"), batch_cols.version_number == bindparam("expected_version"))
+    .values(version_number=batch_cols.version_number + 1, allocated_quantity=bindparam("new_allocated_quantity"))
+)
+
+AVAILABLE_BY_SKU = select(
+    batch_cols.sku, func.sum(batch_cols._purchased_quantity - batch_cols.allocated_quantity).label("available")
+).group_by(batch_cols.sku)
+AVAILABLE_FOR_SKUS = AVAILABLE_BY_SKU.where(batch_cols.sku.in_(bindparam("skus", expanding=True)))
+
+ALLOCATED_LINES = (
+    select(allocation_cols.batch_id, line_cols.id, line_cols.orderid, line_cols.sku, line_cols.qty)
+    .join_from(allocations_table, order_lines_table, allocation_cols.orderline_id == line_cols.id)
+    .where(allocation_cols.batch_id.in_(bindparam("batch_ids", expanding=True)))
+)
+MAX_ORDER_LINE_ID = select(func.coalesce(func.max(line_cols.id), 0))
+INSERT_ORDER_LINES = order_lines_table.insert()
+INSERT_ORDER_LINES_RETURNING = INSERT_ORDER_LINES.returning(line_cols.id, line_cols.orderid, line_cols.sku, line_cols.qty)
+DELETE_ORDER_LINES = order_lines_table.delete().where(line_cols.id == bindparam("orderline_id"))
+
+INSERT_ALLOCATIONS = allocations_table.insert()
+DELETE_ALLOCATIONS = allocations_table.delete().where(allocation_cols.orderline_id == bindparam("orderline_id"))
+
+
+def insert_order_lines(execute: Callable, dialect: Dialect, lines: List[model.OrderLine]) -> List[int]:
+    """
+    Insert order lines in one executemany through `execute` (e.g. Session.execute)
+    and return their ids in the same order, without reading other writers' rows:
+
+    * where `dialect` can return rows from an executemany, the ids come back from the insert itself
+    * elsewhere they are assigned here, above the current maximum, so a concurrent
+      writer taking one of them makes the insert fail instead of mixing up lines
+    """
+    params = [dict(sku=line.sku, qty=line.qty, orderid=line.orderid) for line in lines]
+    if dialect.insert_executemany_returning:
+        ids_by_line = defaultdict(deque) # equal lines are interchangeable, so any of their ids will do
+        for row in execute(INSERT_ORDER_LINES_RETURNING, params):
+            ids_by_line[model.OrderLine(row.orderid, row.sku, row.qty)].append(row.id)
+        return [ids_by_line[line].popleft() for line in lines]
+
+    [[last_id]] = execute(MAX_ORDER_LINE_ID)
+    ids = list(range(last_id + 1, last_id + 1 + len(lines)))
+    execute(INSERT_ORDER_LINES, [dict(row, id=orderline_id) for row, orderline_id in zip(params, ids)])
+    return ids
+
+def _chunks(items: List, size: int) -> Iterator[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a batch was changed by another transaction since this one read it"""
+
+
 class AbstractRepository(abc.ABC):
     @abc.abstractmethod
     def add(self, batch: model.Batch) -> None:
@@ -15,192 +167,600 @@ class AbstractRepository(abc.ABC):
     def get(self, reference) -> model.Batch:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def list(self, sku: Optional[str] = None) -> List[model.Batch]:
+        raise NotImplementedError
+
+    def tracked_references(self) -> Set[str]:
+        """References of the batches already held by this repository, which may carry unsaved changes"""
+        return set()
+
 class SqlRepository(AbstractRepository):
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, metrics: Optional[RepositoryMetrics] = None, record_events: bool = False):
         self.session = session
+        self.metrics = metrics
+        self.record_events = record_events # whether tracked batches keep events for `collect_events`
+        self._stats: Optional[CallStats] = None # stats of the instrumented call in progress, if any
+        # identity map of the batches loaded or added through this repository, along
+        # with their database ids and the order lines (and their ids) known to be persisted
+        self._identity_map: Dict[str, model.Batch] = {}
+        self._batch_ids: Dict[str, int] = {}
+        self._persisted_lines: Dict[str, Dict[model.OrderLine, int]] = {}
+
+    @instrumented
+    def add(self, batch: model.Batch) -> None:
+        """Add a batch, or persist any changes to its allocations if it already exists"""
+        self.add_all([batch])
+
+    @instrumented
+    def add_all(self, batches: Iterable[model.Batch]) -> None:
+        """
+        Persist many batches using a constant number of bulk statements:
 
-    def add(self, batch) -> None:
-        """
-        1) Add batch and get id in batches table
-            -> If batch already exists, then just update: need to add this bit
-        2) Add order_lines allocated to batch and get id from alllocated table
-        3) Add record to allocations table using previous ids
-
-        1 - check if a batch in batches exists with reference
-        2 - if the batch exists, we need to perform some update
-        3 - otherwise...
-        4 - insert batch into batches + query to get the id (pk) of the batch
-        5 - insert order line into order lines + query to get order line ids that have been allocated to the given batch
-        6 - insert the order line id and batch id into allocations intermediate table
-        """
-        # Insert batch into `batches` and get id
-        batch_row = self.session.execute(
-            "SELECT id FROM batches WHERE reference = :reference",
-            dict(reference=batch.reference),
-        ).fetchone()
-
-        if not batch_row:  # have to convert to list for conditional to work
-            self.session.execute(
-                "INSERT INTO batches (reference, sku, _purchased_quantity, eta) VALUES "
-                '(:reference, :sku, :_purchased_quantity, :eta)',
-                dict(
-                    reference=batch.reference,
-                    sku=batch.sku,
-                    _purchased_quantity=batch._purchased_quantity,
-                    eta=batch.eta,
-                ),
+        1 - for batches this repository is not tracking yet:
+            a - look up the ids and versions of batches that already exist by reference
+            b - insert the remaining batches in one executemany and read back their ids
+            c - read the order lines already allocated to the existing batches. A batch
+                read elsewhere (it has a `version_number`) is diffed against them and
+                checked against the version it was read at in step 3. A batch never
+                read takes on the lines it does not hold: nobody saw them deallocated,
+                so they are kept rather than deleted
+        2 - diff each batch's allocations against the order lines known to be persisted
+        3 - bump the version and store the allocated quantity of every existing batch
+            that changed, checking nobody else wrote to it since it was read (raises
+            ConcurrentUpdateError otherwise)
+        4 - delete the allocations (and their order lines) that were removed
+        5 - insert the added order lines in one executemany and read back their ids
+        6 - insert the allocation rows linking order lines to batches in one executemany
+
+        Batches returned by `get`/`list` or previously added are already tracked, so
+        only step 2 onwards runs for them: no read-back query is needed. Batches from
+        `get` whose allocations were never accessed are skipped altogether.
+        """
+        batches = list({batch.reference: batch for batch in batches}.values())
+        if not batches:
+            return
+
+        new_references = set()
+        untracked = [batch for batch in batches if self._identity_map.get(batch.reference) is not batch]
+        if untracked:
+            new_references = self._track_from_database(untracked)
+
+        allocations_to_insert = []
+        lines_to_delete = []
+        for batch in batches:
+            persisted = self._persisted_lines.get(batch.reference)
+            if persisted is None: # allocations never loaded, so they cannot have changed
+                continue
+            allocations_to_insert.extend(
+                (batch.reference, line) for line in batch._allocations if line not in persisted
             )
-            # can use this syntax since guaranteed to have a batch_id exist
-            [[batch_id]] = self.session.execute(
-                "SELECT id FROM batches WHERE reference = :reference",
-                dict(reference=batch.reference),
+            lines_to_delete.extend(
+                (batch.reference, line) for line in persisted if line not in batch._allocations
             )
 
-            # Insert order line that has been allocated to the batch
-            for line in batch._allocations:
-                self.session.execute(
-                    "INSERT INTO order_lines (sku, qty, orderid) VALUES "
-                    '(:sku, :qty, :orderid)',
-                    dict(sku=line.sku, qty=line.qty, orderid=line.orderid)
-                )
-            # Get order line ids of those just inserted
-            orderline_rows = self.session.execute(
-                "SELECT id FROM order_lines WHERE orderid in (:orderids)",
-                dict(orderids=", ".join(map(lambda l: l.orderid, batch._allocations))),
-            ).mappings().fetchall()  # mappings converts row to dict
-
-            # Insert allocations associated with batch
-            for row in orderline_rows:
-                orderline_id = row["id"]
-                self.session.execute(
-                    "INSERT INTO allocations (orderline_id, batch_id) VALUES "
-                    '(:orderline_id, :batch_id)',
-                    dict(orderline_id=orderline_id, batch_id=batch_id),
-                )
+        changed_references = {reference for reference, _ in allocations_to_insert + lines_to_delete}
+        if changed_references - new_references:
+            self._bump_versions(sorted(changed_references - new_references))
 
-        else:
-            # get order_id for those order lines already allocated to a batch
-            orderlines_rows = self.session.execute(
-                """
-                SELECT
-                    ol.orderid,
-                    ol.sku,
-                    ol.qty
-                FROM
-                    order_lines ol
-                LEFT JOIN
-                    allocations a
-                ON
-                    ol.id = a.orderline_id
-                LEFT JOIN
-                    batches b
-                ON
-                    a.batch_id = b.id
-                WHERE
-                    b.reference = :reference
-                """,
-                dict(reference=batch.reference)
-            ).mappings().fetchall()
-
-            orderlines = [model.OrderLine(**line) for line in orderlines_rows]
-            lines_to_allocate = batch._allocations.difference(orderlines)
-            
-            for line in lines_to_allocate:
-                self.session.execute(
-                    "INSERT INTO order_lines (sku, qty, orderid) VALUES "
-                    '(:sku, :qty, :orderid)',
-                    dict(sku=line.sku, qty=line.qty, orderid=line.orderid)
-                )
-            # Get order line ids of those just inserted
-            orderline_rows = self.session.execute(
-                "SELECT id FROM order_lines WHERE orderid in (:orderids)",
-                dict(orderids=", ".join(map(lambda l: l.orderid, lines_to_allocate))),
-            ).mappings().fetchall()  # mappings converts row to dict
-            # Insert allocations associated with batch
-            [batch_id] = batch_row
-            for row in orderline_rows:
-                orderline_id = row["id"]
-                self.session.execute(
-                    "INSERT INTO allocations (orderline_id, batch_id) VALUES "
-                    '(:orderline_id, :batch_id)',
-                    dict(orderline_id=orderline_id, batch_id=batch_id),
-                )
-            
+        if lines_to_delete:
+            self._delete_order_lines(
+                [self._persisted_lines[reference].pop(line) for reference, line in lines_to_delete]
+            )
 
-    def get(self, reference: str) -> model.Batch:
-        # Get batch corresponding to reference
-        [b] = self.session.execute(
-            "SELECT id, reference, sku, _purchased_quantity, eta FROM batches WHERE reference=:reference",
-            dict(reference=reference),
-        )
-        batch = model.Batch(b.reference, b.sku, b._purchased_quantity, b.eta)
+        if not allocations_to_insert:
+            return
 
-        # Get order lines that have been allocated to that batch
-        # !!! NEED TO READ FROM BATCHES FIRST!!!! OTHERWISE THOSE WITHOUT ALLOCATIONS WILL BE EXCLUDED
-        ols = self.session.execute(
-            "SELECT ol.sku, ol.qty, ol.orderid FROM allocations a LEFT JOIN order_lines ol ON a.orderline_id = ol.id WHERE a.batch_id=:batch_id",
-            dict(batch_id=b.id),
+        orderline_ids = self._insert_order_lines([line for _, line in allocations_to_insert])
+        self._write(
+            INSERT_ALLOCATIONS,
+            [
+                dict(orderline_id=orderline_id, batch_id=self._batch_ids[reference])
+                for (reference, _), orderline_id in zip(allocations_to_insert, orderline_ids)
+            ],
         )
-        order_lines = [model.OrderLine(line.orderid, line.sku, line.qty) for line in ols]
+        for (reference, line), orderline_id in zip(allocations_to_insert, orderline_ids):
+            self._persisted_lines[reference][line] = orderline_id
 
-        # Allocate all order lines to batch
-        for line in order_lines:
-            batch.allocate(line)
+    @instrumented
+    def flush(self) -> None:
+        """Write the allocation changes of every tracked batch"""
+        self.add_all(list(self._identity_map.values()))
 
-        return batch
+    def collect_events(self) -> List[events.Event]:
+        """Take the events raised by the tracked batches since they were last collected"""
+        collected = []
+        for batch in self._identity_map.values():
+            if batch.events:
+                collected.extend(batch.events)
+                batch.events.clear()
+        return collected
+
+    def _track(
+        self,
+        batch: model.Batch,
+        batch_id: int,
+        version_number: int,
+        persisted_lines: Optional[Dict[model.OrderLine, int]] = None,
+    ) -> None:
+        """
+        Record a batch in the identity map along with what is persisted for it, and
+        the version its writes are checked against. Without `persisted_lines` the
+        batch's allocations are lazily loaded, which records them through `_load_allocations`.
+        """
+        self._identity_map[batch.reference] = batch
+        self._batch_ids[batch.reference] = batch_id
+        batch.version_number = version_number
+        if self.record_events:
+            batch.record_events()
+        if persisted_lines is not None:
+            self._persisted_lines[batch.reference] = dict(persisted_lines)
+
+    def _load_allocations(self, reference: str) -> Iterable[model.OrderLine]:
+        """Loader for a batch returned by `get`, run when its allocations are first accessed"""
+        batch_id = self._batch_ids[reference]
+        lines = self._get_allocated_lines([batch_id]).get(batch_id, {})
+        self._persisted_lines[reference] = dict(lines)
+        return lines
+
+    def _track_rows(self, rows: Iterable[Row]) -> List[model.Batch]:
+        """Hydrate joined batch rows, returning the tracked instance for each batch"""
+        batches = []
+        for batch_id, version_number, batch, persisted_lines in _hydrate_batches(rows, self._stats):
+            if batch.reference not in self._identity_map:
+                self._track(batch, batch_id, version_number, persisted_lines)
+            batches.append(self._identity_map[batch.reference])
+        return batches
 
+    def _track_from_database(self, batches: List[model.Batch]) -> Set[str]:
+        """
+        Insert the batches that do not exist yet and track all of them with their
+        persisted lines, returning the references of the inserted batches. Batches
+        read elsewhere keep the version they were read at (see `add_all`)
+        """
+        batch_rows = self._get_batch_rows([batch.reference for batch in batches])
+        persisted_lines = self._get_allocated_lines([row.id for row in batch_rows.values()])
+
+        new_batches = [batch for batch in batches if batch.reference not in batch_rows]
+        if new_batches:
+            self._write(
+                INSERT_BATCHES,
+                [
+                    dict(
+                        reference=batch.reference,
+                        sku=batch.sku,
+                        _purchased_quantity=batch._purchased_quantity,
+                        eta=batch.eta,
+                        allocated_quantity=batch.allocated_quantity,
+                    )
+                    for batch in new_batches
+                ],
+            )
+            batch_rows.update(self._get_batch_rows([batch.reference for batch in new_batches]))
 
-    def list(self) -> Set[model.Batch]:
-        """
-        for each batch in batches table:
-            1 - construct batch object
-            2 - construct allocated order lines
-            3 - allocate those order lines
-        
-        """
-        # get all batches in the batches tables: alias to match Batch constructor
-        rows = self.session.execute(
-            """
-            SELECT
-                reference as ref,
-                sku,
-                eta,
-                _purchased_quantity as qty
-            FROM
-                batches
-            """
-        ).mappings().fetchall()
-
-        # create Batch objects from query result
-        batches = [model.Batch(**batch) for batch in rows]
-        
-        # for each batch, fetch all order lines allocated, instantiate and allocate
+        inserted = {batch.reference for batch in new_batches}
         for batch in batches:
-            rows = self.session.execute(
-                """
-                SELECT
-                    ol.orderid,
-                    ol.sku,
-                    ol.qty
-                FROM
-                    batches b
-                LEFT JOIN
-                    allocations a 
-                ON
-                    b.id = a.batch_id
-                LEFT JOIN
-                    order_lines ol
-                ON
-                    a.orderline_id = ol.id
-                WHERE
-                    b.reference = :reference
-                """,
-                dict(reference=batch.reference),
+            row = batch_rows[batch.reference]
+            lines = persisted_lines.get(row.id, {})
+            if batch.reference in inserted or batch.version_number is None:
+                if lines.keys() - batch._allocations:
+                    batch.restore_allocations(batch._allocations | lines.keys())
+                self._track(batch, row.id, row.version_number, lines)
+            else:
+                self._track(batch, row.id, batch.version_number, lines)
+        return inserted
+
+    def _get_batch_rows(self, references: List[str]) -> Dict[str, Row]:
+        """Map batch references to their (id, version_number) rows, for those that exist"""
+        batch_rows = {}
+        for chunk in _chunks(references, IN_CLAUSE_CHUNK_SIZE):
+            rows = self._read(BATCH_VERSIONS_BY_REFERENCES, dict(references=chunk))
+            batch_rows.update({row.reference: row for row in rows})
+        return batch_rows
+
+    def _bump_versions(self, references: List[str]) -> None:
+        """
+        Increment the version of each batch and store its allocated quantity, but
+        only where it still has the version it was read with: if another writer got
+        there first nothing is updated for that batch and ConcurrentUpdateError is
+        raised, leaving the caller to roll back and retry from fresh reads
+        """
+        statement = BUMP_BATCH_VERSION
+        params = [
+            dict(
+                batch_id=self._batch_ids[reference],
+                expected_version=self._identity_map[reference].version_number,
+                new_allocated_quantity=self._identity_map[reference].allocated_quantity,
             )
+            for reference in references
+        ]
+        if len(params) == 1 or self.session.get_bind().dialect.supports_sane_multi_rowcount:
+            updated = self._write(statement, params if len(params) > 1 else params[0]).rowcount
+        else:
+            updated = sum(self._write(statement, param).rowcount for param in params)
+        if updated != len(params):
+            raise ConcurrentUpdateError(f"Batches {', '.join(references)} were changed by another transaction")
+        for reference in references:
+            self._identity_map[reference].version_number += 1
 
-            order_lines = [model.OrderLine(**line) for line in rows]
+    def _get_allocated_lines(self, batch_ids: List[int]) -> Dict[int, Dict[model.OrderLine, int]]:
+        """Order lines (mapped to their ids) already allocated to each of the given batch ids"""
+        lines = defaultdict(dict)
+        for chunk in _chunks(batch_ids, IN_CLAUSE_CHUNK_SIZE):
+            rows = self._read(ALLOCATED_LINES, dict(batch_ids=chunk))
+            for row in rows:
+                lines[row.batch_id][model.OrderLine(row.orderid, row.sku, row.qty)] = row.id
+        return lines
 
-            for line in order_lines:
-                batch.allocate(line)
+    def _insert_order_lines(self, lines: List[model.OrderLine]) -> List[int]:
+        """Insert order lines in one executemany and return their ids in the same order"""
+        return insert_order_lines(self._write, self.session.get_bind().dialect, lines)
 
-        return batches
+    def _delete_order_lines(self, orderline_ids: List[int]) -> None:
+        """Delete deallocated order lines along with their allocation rows"""
+        params = [dict(orderline_id=orderline_id) for orderline_id in orderline_ids]
+        self._write(DELETE_ALLOCATIONS, params)
+        self._write(DELETE_ORDER_LINES, params)
+
+    def _read(self, statement, params=None, **kwargs) -> Iterator[Row]:
+        """Execute a query, counting the statement and (as they are consumed) its rows"""
+        result = self.session.execute(statement, params, **kwargs)
+        if self._stats is None:
+            return iter(result)
+        self._stats.statements += 1
+        return self._count_rows(result, self._stats)
+
+    @staticmethod
+    def _count_rows(result, stats: CallStats) -> Iterator[Row]:
+        for row in result:
+            stats.rows_read += 1
+            yield row
+
+    def _write(self, statement, params=None):
+        """Execute a (possibly executemany) write, counting the statement and rows it affected"""
+        result = self.session.execute(statement, params)
+        if self._stats is not None:
+            self._stats.statements += 1
+            if result.rowcount >= 0:
+                self._stats.rows_written += result.rowcount
+            elif isinstance(params, list):
+                self._stats.rows_written += len(params)
+        return result
+
+    def tracked_references(self) -> Set[str]:
+        return set(self._identity_map)
+
+    @instrumented
+    def get(self, reference: str, lazy: bool = True) -> model.Batch:
+        """
+        Return the tracked batch for `reference`, reading only its batches row on first use.
+
+        Its order lines are fetched when `_allocations` is first accessed (e.g. by
+        `allocate`), while `allocated_quantity` comes from the stored total, so
+        lookups that only need the batch's own fields never read order lines.
+        Pass `lazy=False` to load them straight away, e.g. when the session will
+        be closed or cannot be used from where the batch ends up.
+        """
+        if reference not in self._identity_map:
+            [row] = self._read(BATCH_BY_REFERENCE, dict(reference=reference))
+            batch = model.Batch(row.reference, row.sku, row._purchased_quantity, row.eta)
+            batch.defer_allocations(lambda: self._load_allocations(reference), row.allocated_quantity)
+            self._track(batch, row.id, row.version_number)
+
+        batch = self._identity_map[reference]
+        if not lazy:
+            batch._allocations
+        return batch
+
+    @instrumented
+    def list(self, sku: Optional[str] = None) -> List[model.Batch]:
+        """
+        Load batches (optionally only those for `sku`) together with their
+        allocated order lines in one joined query, building each Batch as its
+        rows go past. Batches already tracked are returned as the tracked instance.
+        """
+        if sku is None:
+            rows = self._read(BATCHES_WITH_LINES)
+        else:
+            rows = self._read(BATCHES_WITH_LINES_FOR_SKU, dict(sku=sku))
+        return self._track_rows(rows)
+
+    @instrumented
+    def available_quantities(self, skus: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """
+        Stock still available per SKU (for every SKU, or only those in `skus`), summed
+        over the batches rows alone in one aggregate query per IN clause chunk:
+        neither order lines nor allocations are read and no Batch is built.
+        Requested SKUs without any batches map to 0.
+        """
+        if skus is None:
+            return {row.sku: row.available for row in self._read(AVAILABLE_BY_SKU)}
+
+        skus = sorted(set(skus))
+        available = dict.fromkeys(skus, 0)
+        for chunk in _chunks(skus, IN_CLAUSE_CHUNK_SIZE):
+            rows = self._read(AVAILABLE_FOR_SKUS, dict(skus=chunk))
+            available.update({row.sku: row.available for row in rows})
+        return available
+
+    @instrumented
+    def for_order(self, orderid: str) -> List[model.Batch]:
+        """
+        Load the batches holding lines of `orderid` in one query, going from the
+        indexed `order_lines.orderid` through `allocations` to the batch ids.
+        Batches already tracked are returned as the tracked instance.
+        """
+        rows = self._read(BATCHES_WITH_LINES_FOR_ORDER, dict(orderid=orderid))
+        return self._track_rows(rows)
+
+    @instrumented
+    def iter_batches(self, chunk_size: int = 1000, sku: Optional[str] = None) -> Iterator[model.Batch]:
+        """
+        Stream batches with their allocations, holding at most `chunk_size`
+        batches in memory at a time:
+
+        1 - read the next `chunk_size` batch ids after the last one seen (keyset pagination)
+        2 - load that id range with its order lines, streaming rows from the cursor
+        3 - yield the hydrated batches and move on to the next chunk
+
+        Streamed batches are not added to the identity map, which would otherwise
+        grow with the whole table.
+        """
+        for _, _, batch in self._iter_hydrated(chunk_size, sku):
+            yield batch
+
+    @instrumented
+    def iter_batch_versions(
+        self,
+        chunk_size: int = 1000,
+        sku: Optional[str] = None,
+        references: Optional[Iterable[str]] = None,
+    ) -> Iterator[Tuple[int, int, model.Batch]]:
+        """
+        As `iter_batches`, yielding (batch id, version number, batch) so callers
+        keeping their own copies can tell later which batches changed. With
+        `references`, only those batches are loaded (in id order per IN clause chunk).
+        """
+        if references is None:
+            yield from self._iter_hydrated(chunk_size, sku)
+            return
+        for chunk in _chunks(sorted(set(references)), IN_CLAUSE_CHUNK_SIZE):
+            rows = self._read(
+                BATCHES_WITH_LINES_FOR_REFERENCES,
+                dict(references=chunk),
+                execution_options=dict(stream_results=True),
+            )
+            for batch_id, version_number, batch, _ in _hydrate_batches(rows, self._stats):
+                yield batch_id, version_number, batch
+
+    def _iter_hydrated(self, chunk_size: int, sku: Optional[str]) -> Iterator[Tuple[int, int, model.Batch]]:
+        if sku is None:
+            ids_page, batches_in_range = BATCH_IDS_PAGE, BATCHES_WITH_LINES_IN_ID_RANGE
+        else:
+            ids_page, batches_in_range = BATCH_IDS_PAGE_FOR_SKU, BATCHES_WITH_LINES_FOR_SKU_IN_ID_RANGE
+        last_id = 0
+        while True:
+            batch_ids = [
+                row.id for row in self._read(ids_page, dict(last_id=last_id, sku=sku, chunk_size=chunk_size))
+            ]
+            if not batch_ids:
+                return
+
+            rows = self._read(
+                batches_in_range,
+                dict(last_id=last_id, chunk_last_id=batch_ids[-1], sku=sku),
+                execution_options=dict(stream_results=True),
+            )
+            for batch_id, version_number, batch, _ in _hydrate_batches(rows, self._stats):
+                yield batch_id, version_number, batch
+            last_id = batch_ids[-1]
+
+
+class AsyncSqlRepository:
+    """
+    The `SqlRepository` contract for asyncio code, over an `AsyncSession`.
+
+    Each call runs the SqlRepository statements through `AsyncSession.run_sync`,
+    so the event loop stays free to serve other requests while this one waits
+    on the database. The identity map and change tracking behave as they do
+    for SqlRepository.
+    """
+
+    def __init__(self, session: AsyncSession, metrics: Optional[RepositoryMetrics] = None):
+        self.session = session
+        self._repo = SqlRepository(session.sync_session, metrics)
+
+    async def add(self, batch: model.Batch) -> None:
+        await self.session.run_sync(lambda _: self._repo.add(batch))
+
+    async def add_all(self, batches: Iterable[model.Batch]) -> None:
+        batches = list(batches)
+        await self.session.run_sync(lambda _: self._repo.add_all(batches))
+
+    async def get(self, reference: str) -> model.Batch:
+        # loaded eagerly: a lazy load would run outside run_sync, where the session cannot be used
+        return await self.session.run_sync(lambda _: self._repo.get(reference, lazy=False))
+
+    async def list(self, sku: Optional[str] = None) -> List[model.Batch]:
+        return await self.session.run_sync(lambda _: self._repo.list(sku))
+
+    async def available_quantities(self, skus: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        skus = list(skus) if skus is not None else None
+        return await self.session.run_sync(lambda _: self._repo.available_quantities(skus))
+
+    async def for_order(self, orderid: str) -> List[model.Batch]:
+        return await self.session.run_sync(lambda _: self._repo.for_order(orderid))
+
+
+def _hydrate_batches(
+    rows, stats: Optional[CallStats] = None
+) -> Iterator[Tuple[int, int, model.Batch, Dict[model.OrderLine, int]]]:
+    """
+    Build batches from batch rows LEFT JOINed to their order lines, ordered by batch id,
+    yielding each batch with its id, its version and the ids of its order lines.
+    Time spent building model objects is added to `stats`, when given.
+    """
+    batch_id, version_number, batch, line_ids = None, None, None, {}
+    for row in rows:
+        if row.id != batch_id and batch is not None:
+            batch.restore_allocations(line_ids)
+            yield batch_id, version_number, batch, line_ids
+        started = time.perf_counter() if stats is not None else 0.0
+        if row.id != batch_id:
+            batch = model.Batch(row.reference, row.sku, row._purchased_quantity, row.eta)
+            batch.version_number = row.version_number
+            batch_id, version_number, line_ids = row.id, row.version_number, {}
+        if row.orderline_id is not None: # batches without allocations still produce one row
+            line_ids[model.OrderLine(row.orderid, row.line_sku, row.qty)] = row.orderline_id
+        if stats is not None:
+            stats.hydration_time += time.perf_counter() - started
+    if batch is not None:
+        batch.restore_allocations(line_ids)
+        yield batch_id, version_number, batch, line_ids
+
+
+# immutable copy of a batch's state that is safe to share between requests: reference, sku,
+# purchased quantity, ETA, version number, allocated quantity and the order lines, if they were loaded
+BatchSnapshot = Tuple[str, str, int, Optional[date], Optional[int], int, Optional[FrozenSet[model.OrderLine]]]
+
+
+def _snapshot(batch: model.Batch) -> BatchSnapshot:
+    """Copy a batch's state, without loading allocations that were deferred"""
+    lines = frozenset(batch._lines) if batch._loader is None else None
+    return (
+        batch.reference, batch.sku, batch._purchased_quantity, batch.eta, batch.version_number, batch.allocated_quantity, lines
+    )
+
+def _restore(snapshot: BatchSnapshot, loader: Callable[[], Iterable[model.OrderLine]]) -> model.Batch:
+    """Rebuild a batch from a snapshot, using `loader` for its order lines if they were not in it"""
+    reference, sku, qty, eta, version_number, allocated_quantity, lines = snapshot
+    batch = model.Batch(reference, sku, qty, eta)
+    batch.version_number = version_number # writes are checked against the version the snapshot was taken at
+    if lines is None:
+        batch.defer_allocations(loader, allocated_quantity)
+    else:
+        batch.restore_allocations(lines)
+    return batch
+
+
+class BatchCache:
+    """
+    Bounded, thread-safe cache of batch snapshots shared across requests.
+
+    Entries are keyed by batch reference and by SKU (for `list` results) and
+    evicted least recently used first once `max_entries` is reached, or once
+    they are older than `ttl` seconds if a ttl is given.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, Optional[str]], Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_batch(self, reference: str) -> Optional[BatchSnapshot]:
+        return self._get(("batch", reference))
+
+    def put_batch(self, batch: model.Batch) -> None:
+        self._put(("batch", batch.reference), _snapshot(batch))
+
+    def get_list(self, sku: Optional[str]) -> Optional[Tuple[BatchSnapshot, ...]]:
+        return self._get(("list", sku))
+
+    def put_list(self, sku: Optional[str], batches: List[model.Batch]) -> None:
+        self._put(("list", sku), tuple(_snapshot(batch) for batch in batches))
+
+    def invalidate(self, batch: model.Batch) -> None:
+        """Drop every entry that may include `batch`"""
+        with self._lock:
+            for key in (("batch", batch.reference), ("list", batch.sku), ("list", None)):
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and self.clock() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+class CachingRepository(AbstractRepository):
+    """
+    Read-through cache in front of another repository.
+
+    Reads are served from a shared `BatchCache` when possible, each request
+    getting its own Batch instances rebuilt from the cached snapshots (and the
+    same instance on repeated reads of a reference). `add` writes through to
+    the wrapped repository and invalidates the cached entries for the batch.
+
+    Snapshots keep the version each batch was read at, so writing a batch
+    rebuilt from a snapshot that went stale raises ConcurrentUpdateError.
+    Batches from `get` are cached without their order lines unless these were
+    already loaded, and a rebuilt batch loads them through the wrapped repository.
+    Only batches freshly read by the wrapped repository are cached: one it already
+    held may have changes that are not committed yet, and may never be.
+    """
+
+    def __init__(self, repo: AbstractRepository, cache: BatchCache):
+        self.repo = repo
+        self.cache = cache
+        self._seen: Dict[str, model.Batch] = {}
+
+    def add(self, batch: model.Batch) -> None:
+        self.repo.add(batch)
+        self.cache.invalidate(batch)
+        self._seen[batch.reference] = batch
+
+    def get(self, reference: str) -> model.Batch:
+        if reference in self._seen:
+            return self._seen[reference]
+        snapshot = self.cache.get_batch(reference)
+        if snapshot is not None:
+            batch = self._restore(snapshot)
+        else:
+            tracked = reference in self.repo.tracked_references()
+            batch = self.repo.get(reference)
+            if not tracked:
+                self.cache.put_batch(batch)
+        self._seen[reference] = batch
+        return batch
+
+    def list(self, sku: Optional[str] = None) -> List[model.Batch]:
+        snapshots = self.cache.get_list(sku)
+        if snapshots is not None:
+            batches = [self._seen.get(snapshot[0]) or self._restore(snapshot) for snapshot in snapshots]
+        else:
+            tracked = self.repo.tracked_references()
+            batches = self.repo.list(sku)
+            if not any(batch.reference in tracked for batch in batches):
+                self.cache.put_list(sku, batches)
+        for batch in batches:
+            self._seen.setdefault(batch.reference, batch)
+        return [self._seen[batch.reference] for batch in batches]
+
+    def _restore(self, snapshot: BatchSnapshot) -> model.Batch:
+        reference = snapshot[0]
+        return _restore(snapshot, lambda: self.repo.get(reference)._allocations)
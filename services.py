@@ -0,0 +1,120 @@
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import TypeVar
+
+import events
+import model
+import respository
+import unit_of_work
+
+
+# how many times an allocation is attempted when other workers keep winning the race
+MAX_ATTEMPTS = 5
+
+T = TypeVar("T")
+
+
+def _with_retries(uow: unit_of_work.AbstractUnitOfWork, max_attempts: int, work: Callable[[], T]) -> T:
+    """Run `work` in the unit of work and commit, retrying from fresh reads on ConcurrentUpdateError"""
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with uow:
+                result = work()
+                uow.commit()
+            return result
+        except respository.ConcurrentUpdateError:
+            if attempt == max_attempts:
+                raise
+
+
+def allocate(
+    line: model.OrderLine,
+    uow: unit_of_work.AbstractUnitOfWork,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> str:
+    """
+    Allocate an Order Line to one of the batches for its SKU and commit.
+
+    If another worker changes one of the batches between our read and our
+    commit, the unit of work is rolled back and the allocation retried
+    from fresh reads, up to `max_attempts` times.
+    """
+    try:
+        return _with_retries(uow, max_attempts, lambda: model.allocate(line, uow.batches.list(sku=line.sku)))
+    except model.OutOfStock:
+        _record_out_of_stock(uow, [line])
+        raise
+
+
+def allocate_lines(
+    lines: Iterable[model.OrderLine],
+    uow: unit_of_work.AbstractUnitOfWork,
+    commit_every: int = 1000,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> List[Optional[str]]:
+    """
+    Allocate many Order Lines, committing once per `commit_every` lines rather than per line.
+
+    Returns the allocated batch reference for each line, or None for lines that
+    are out of stock. A chunk that conflicts with another worker is retried on
+    its own, as in `allocate`.
+    """
+    lines = list(lines)
+    results: List[Optional[str]] = []
+    for start in range(0, len(lines), commit_every):
+        chunk = lines[start:start + commit_every]
+
+        def allocate_chunk():
+            batches = [batch for sku in {line.sku for line in chunk} for batch in uow.batches.list(sku=sku)]
+            return model.allocate_many(chunk, batches)
+
+        chunk_results = _with_retries(uow, max_attempts, allocate_chunk)
+        _record_out_of_stock(uow, [line for line, result in zip(chunk, chunk_results) if result is None])
+        results.extend(chunk_results)
+    return results
+
+
+def deallocate(
+    orderid: str,
+    uow: unit_of_work.AbstractUnitOfWork,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> List[model.OrderLine]:
+    """
+    Cancel an order: remove its lines from the batches holding them and commit.
+
+    Only those batches are loaded, found by order id in a single query.
+    Returns the removed lines (empty when the order has no allocations).
+    """
+    return _with_retries(
+        uow, max_attempts, lambda: model.AllocationIndex(uow.batches.for_order(orderid)).deallocate(orderid)
+    )
+
+
+def reallocate(
+    orderid: str,
+    uow: unit_of_work.AbstractUnitOfWork,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> List[Optional[str]]:
+    """
+    Deallocate an order and allocate its lines again against every batch for their SKUs, then commit.
+
+    Returns the batch reference for each of the order's lines, or None for
+    lines that no longer fit anywhere (those stay deallocated).
+    """
+    def reallocate_order():
+        skus = {batch.sku for batch in uow.batches.for_order(orderid)}
+        index = model.AllocationIndex(batch for sku in sorted(skus) for batch in uow.batches.list(sku=sku))
+        lines = index.deallocate(orderid)
+        return lines, index.allocate_many(lines)
+
+    lines, results = _with_retries(uow, max_attempts, reallocate_order)
+    _record_out_of_stock(uow, [line for line, result in zip(lines, results) if result is None])
+    return results
+
+
+def _record_out_of_stock(uow: unit_of_work.AbstractUnitOfWork, lines: List[model.OrderLine]) -> None:
+    """The model signals these by raising or returning None, so they are logged here rather than by a batch"""
+    if uow.event_log is not None and lines:
+        uow.event_log.record(events.OutOfStock(line.orderid, line.sku, line.qty) for line in lines)
@@ -0,0 +1,258 @@
+"""
+Binary snapshots of the whole inventory, for a fast warm start.
+
+A snapshot file holds every batch with its database id and version number,
+in allocation order per SKU, followed by their order lines. All strings are
+stored once in a string table. The file is memory-mapped on load, and each
+batch's order lines are only decoded when its allocations are first used.
+
+The header carries a consistency marker (batch count, sum of version numbers,
+highest batch id) that can be compared with the database's cheaply. When the
+two differ, `refresh` reloads only the batches that are new or whose version
+changed.
+"""
+from dataclasses import dataclass
+from datetime import date
+import mmap
+import os
+import struct
+from typing import Dict
+from typing import Iterable
+from typing import List
+
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from columnar import WAREHOUSE_ETA
+from db_tables import batches as batches_table
+import model
+import respository
+
+
+MAGIC = b"ALSN"
+FORMAT_VERSION = 1
+
+# magic, format version, string count, batch count, line count, version sum, max batch id
+HEADER = struct.Struct("<4sHIIIqq")
+STRING_OFFSET = struct.Struct("<Q")
+# id, version number, reference, sku, ETA ordinal, purchased quantity, allocated quantity, line count
+BATCH = struct.Struct("<qqIIiqqI")
+# orderid, sku, qty
+LINE = struct.Struct("<IIq")
+
+MARKER_QUERY = select(
+    func.count(batches_table.c.id),
+    func.coalesce(func.sum(batches_table.c.version_number), 0),
+    func.coalesce(func.max(batches_table.c.id), 0),
+)
+VERSIONS_QUERY = select(batches_table.c.reference, batches_table.c.version_number)
+
+
+class InvalidSnapshot(ValueError):
+    """Raised for a file that is not a snapshot this code can read"""
+
+
+@dataclass(frozen=True)
+class SnapshotMarker:
+    batches: int
+    version_sum: int
+    max_id: int
+
+
+@dataclass(frozen=True)
+class SnapshotEntry:
+    batch_id: int
+    version_number: int
+    batch: model.Batch
+
+
+class Snapshot:
+    """Batches with the database id and version each was read at"""
+
+    def __init__(self, entries: Iterable[SnapshotEntry] = ()):
+        self.entries: Dict[str, SnapshotEntry] = {entry.batch.reference: entry for entry in entries}
+
+    @property
+    def marker(self) -> SnapshotMarker:
+        return SnapshotMarker(
+            batches=len(self.entries),
+            version_sum=sum(entry.version_number for entry in self.entries.values()),
+            max_id=max((entry.batch_id for entry in self.entries.values()), default=0),
+        )
+
+    def batches(self) -> List[model.Batch]:
+        """Batches grouped by SKU, each group in allocation order"""
+        return [entry.batch for entry in _in_allocation_order(self.entries.values())]
+
+    def index(self) -> model.AllocationIndex:
+        return model.AllocationIndex(self.batches())
+
+
+def database_marker(session: Session) -> SnapshotMarker:
+    """The consistency marker of the batches table, from one aggregate query"""
+    [(batches, version_sum, max_id)] = session.execute(MARKER_QUERY)
+    return SnapshotMarker(batches, version_sum, max_id)
+
+def is_current(snapshot: Snapshot, session: Session) -> bool:
+    return snapshot.marker == database_marker(session)
+
+
+def take(session: Session, chunk_size: int = 1000) -> Snapshot:
+    """Read every batch from the database into a new snapshot"""
+    return Snapshot(
+        SnapshotEntry(batch_id, version_number, batch)
+        for batch_id, version_number, batch in respository.SqlRepository(session).iter_batch_versions(chunk_size)
+    )
+
+
+def refresh(snapshot: Snapshot, session: Session) -> int:
+    """
+    Bring a snapshot up to date with the database, returning how many batches changed:
+
+    1 - compare the markers, stopping if they match
+    2 - read every batch's version number (from the batches table alone)
+    3 - reload the batches that are new or have another version, and drop the ones that are gone
+    """
+    if is_current(snapshot, session):
+        return 0
+    versions = {row.reference: row.version_number for row in session.execute(VERSIONS_QUERY)}
+    stale = [
+        reference for reference, version_number in versions.items()
+        if reference not in snapshot.entries or snapshot.entries[reference].version_number != version_number
+    ]
+    removed = [reference for reference in snapshot.entries if reference not in versions]
+    for reference in removed:
+        del snapshot.entries[reference]
+    repo = respository.SqlRepository(session)
+    for batch_id, version_number, batch in repo.iter_batch_versions(references=stale):
+        snapshot.entries[batch.reference] = SnapshotEntry(batch_id, version_number, batch)
+    return len(stale) + len(removed)
+
+
+def save(snapshot: Snapshot, path: str) -> None:
+    """Write the snapshot to `path`, atomically replacing any previous file"""
+    strings: Dict[str, int] = {}
+    def intern(value: str) -> int:
+        return strings.setdefault(value, len(strings))
+
+    entries = _in_allocation_order(snapshot.entries.values())
+    batch_records, line_records = [], []
+    for entry in entries:
+        batch = entry.batch
+        lines = sorted(batch._allocations, key=lambda line: (line.orderid, line.sku, line.qty))
+        batch_records.append(BATCH.pack(
+            entry.batch_id,
+            entry.version_number,
+            intern(batch.reference),
+            intern(batch.sku),
+            batch.eta.toordinal() if batch.eta is not None else WAREHOUSE_ETA,
+            batch._purchased_quantity,
+            batch.allocated_quantity,
+            len(lines),
+        ))
+        line_records.extend(LINE.pack(intern(line.orderid), intern(line.sku), line.qty) for line in lines)
+
+    encoded = [value.encode("utf-8") for value in strings]
+    offsets, position = [], 0
+    for value in encoded:
+        offsets.append(position)
+        position += len(value)
+    offsets.append(position)
+
+    marker = snapshot.marker
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(
+            MAGIC, FORMAT_VERSION, len(encoded), len(batch_records), len(line_records), marker.version_sum, marker.max_id
+        ))
+        f.write(b"".join(STRING_OFFSET.pack(offset) for offset in offsets))
+        f.write(b"".join(encoded))
+        f.write(b"".join(batch_records))
+        f.write(b"".join(line_records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read_marker(path: str) -> SnapshotMarker:
+    """The consistency marker of a snapshot file, read from its header alone"""
+    with open(path, "rb") as f:
+        _, _, _, batches, _, version_sum, max_id = _unpack_header(f.read(HEADER.size))
+    return SnapshotMarker(batches, version_sum, max_id)
+
+
+def load(path: str) -> Snapshot:
+    """
+    Memory-map a snapshot file and build its batches.
+
+    Each batch gets the allocated quantity stored for it straight away, while its
+    order lines are decoded from the mapping only when its allocations are first
+    accessed (building an AllocationIndex does so for every batch).
+    """
+    with open(path, "rb") as f:
+        _unpack_header(f.read(HEADER.size)) # also rejects empty files, which cannot be mapped
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _, _, string_count, batch_count, _, _, _ = _unpack_header(buffer[:HEADER.size])
+
+    position = HEADER.size
+    offsets_size = (string_count + 1) * STRING_OFFSET.size
+    offsets = [offset for (offset,) in STRING_OFFSET.iter_unpack(buffer[position:position + offsets_size])]
+    position += offsets_size
+    blob = buffer[position:position + offsets[-1]]
+    strings = [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(string_count)]
+    position += offsets[-1]
+
+    lines_start = position + batch_count * BATCH.size
+    entries = []
+    first_line = 0
+    for batch_id, version_number, reference, sku, eta, purchased, allocated, line_count in BATCH.iter_unpack(
+        buffer[position:lines_start]
+    ):
+        batch = model.Batch(
+            strings[reference], strings[sku], purchased, date.fromordinal(eta) if eta != WAREHOUSE_ETA else None
+        )
+        batch.version_number = version_number
+        start = lines_start + first_line * LINE.size
+        batch.defer_allocations(
+            lambda start=start, stop=start + line_count * LINE.size: [
+                model.OrderLine(strings[orderid], strings[line_sku], qty)
+                for orderid, line_sku, qty in LINE.iter_unpack(buffer[start:stop])
+            ],
+            allocated,
+        )
+        entries.append(SnapshotEntry(batch_id, version_number, batch))
+        first_line += line_count
+    return Snapshot(entries)
+
+
+def warm_start(path: str, session: Session) -> Snapshot:
+    """
+    Load the snapshot at `path` (or take a new one when there is none), top it up
+    from the database and save it back if anything changed
+    """
+    if os.path.exists(path):
+        snapshot = load(path)
+        if refresh(snapshot, session):
+            save(snapshot, path)
+    else:
+        snapshot = take(session)
+        save(snapshot, path)
+    return snapshot
+
+
+def _unpack_header(data: bytes) -> tuple:
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise InvalidSnapshot("Not an allocation snapshot")
+    header = HEADER.unpack(data)
+    if header[1] != FORMAT_VERSION:
+        raise InvalidSnapshot(f"Unsupported snapshot format version {header[1]}")
+    return header
+
+
+def _in_allocation_order(entries: Iterable[SnapshotEntry]) -> List[SnapshotEntry]:
+    """Group by SKU, then warehouse stock first, earliest ETA, and database id to break ties"""
+    return sorted(
+        entries,
+        key=lambda entry: (entry.batch.sku, entry.batch.eta is not None, entry.batch.eta or date.min, entry.batch_id),
+    )
@@ -6,6 +6,8 @@ import pytest
 
 from model import (
     allocate,
+    allocate_many,
+    AllocationIndex,
     Batch,
     OrderLine,
     OutOfStock,
@@ -69,3 +71,182 @@ def test_return_allocated_batch_ref():
     allocation = allocate(line, [shipment_batch, in_stock_batch])
     
     assert allocation == in_stock_batch.reference
+
+def test_index_prefers_warehouse_then_earliest_batch():
+    latest = Batch("batch-003", "YELLOW-CHAIR", 10, later)
+    earliest = Batch("batch-002", "YELLOW-CHAIR", 10, tomorrow)
+    warehouse = Batch("batch-001", "YELLOW-CHAIR", 5, None)
+    index = AllocationIndex([latest, earliest, warehouse])
+
+    assert index.batches_for("YELLOW-CHAIR") == [warehouse, earliest, latest]
+    assert index.allocate(OrderLine("order-1", "YELLOW-CHAIR", 4)) == "batch-001"
+    assert index.allocate(OrderLine("order-2", "YELLOW-CHAIR", 4)) == "batch-002"
+    assert warehouse.available_quantity == 1
+    assert earliest.available_quantity == 6
+
+def test_index_only_considers_batches_with_matching_sku():
+    chair = Batch("batch-001", "RED-CHAIR", 10, None)
+    table = Batch("batch-002", "RED-TABLE", 10, None)
+    index = AllocationIndex([chair, table])
+
+    assert index.allocate(OrderLine("order-1", "RED-TABLE", 2)) == "batch-002"
+    assert chair.available_quantity == 10
+
+def test_index_raises_out_of_stock_like_allocate():
+    index = AllocationIndex([Batch("batch-001", "GREEN-CHAIR", 2, today)])
+
+    with pytest.raises(OutOfStock, match="GREEN-CHAIR"):
+        index.allocate(OrderLine("order-ref", "GREEN-CHAIR", 6))
+    with pytest.raises(OutOfStock, match="BLUE-SOFA"):
+        index.allocate(OrderLine("order-ref", "BLUE-SOFA", 1))
+
+def test_index_matches_allocate_across_many_lines():
+    def make_batches():
+        return [
+            Batch(f"batch-{i}", f"SKU-{i % 7}", 20, None if i % 3 == 0 else today + timedelta(days=i % 5))
+            for i in range(60)
+        ]
+    lines = [OrderLine(f"order-{i}", f"SKU-{i % 7}", 1 + i % 9) for i in range(400)]
+
+    def run(allocator, batches):
+        results = []
+        for line in lines:
+            try:
+                results.append(allocator(line, batches))
+            except OutOfStock:
+                results.append(None)
+        return results
+
+    index = AllocationIndex(make_batches())
+    assert run(allocate, make_batches()) == run(lambda line, _: index.allocate(line), None)
+
+def test_allocate_many_returns_a_result_per_line():
+    warehouse = Batch("batch-001", "RED-CHAIR", 10, None)
+    shipment = Batch("batch-002", "RED-CHAIR", 10, tomorrow)
+    lamp = Batch("batch-003", "RED-LAMP", 1, None)
+    lines = [
+        OrderLine("order-1", "RED-CHAIR", 8),
+        OrderLine("order-2", "RED-LAMP", 5),
+        OrderLine("order-3", "RED-CHAIR", 8),
+        OrderLine("order-4", "BLUE-SOFA", 1),
+        OrderLine("order-5", "RED-CHAIR", 2),
+    ]
+
+    results = allocate_many(lines, [shipment, lamp, warehouse])
+
+    assert results == ["batch-001", None, "batch-002", None, "batch-001"]
+    assert warehouse.available_quantity == 0
+    assert shipment.available_quantity == 2
+    assert lamp.available_quantity == 1
+
+def test_allocate_many_matches_sequential_allocate():
+    def make_batches():
+        return [
+            Batch(f"batch-{i}", f"SKU-{i % 5}", 15, None if i % 4 == 0 else today + timedelta(days=i % 6))
+            for i in range(40)
+        ]
+    lines = [OrderLine(f"order-{i}", f"SKU-{i % 6}", 1 + i % 11) for i in range(500)]
+
+    sequential_batches = make_batches()
+    expected = []
+    for line in lines:
+        try:
+            expected.append(allocate(line, sequential_batches))
+        except OutOfStock:
+            expected.append(None)
+
+    bulk_batches = make_batches()
+    assert allocate_many(lines, bulk_batches) == expected
+    assert [b.available_quantity for b in bulk_batches] == [b.available_quantity for b in sequential_batches]
+
+def test_index_deallocates_an_order_from_every_batch_holding_it():
+    chair = Batch("batch-001", "RED-CHAIR", 10, None)
+    lamp = Batch("batch-002", "RED-LAMP", 10, None)
+    lamp.allocate(OrderLine("order-1", "RED-LAMP", 4)) # allocated before the index was built
+    index = AllocationIndex([chair, lamp])
+    index.allocate(OrderLine("order-1", "RED-CHAIR", 3))
+    index.allocate(OrderLine("order-2", "RED-CHAIR", 5))
+
+    assert index.orders_for("order-1") == ["batch-001", "batch-002"]
+    removed = index.deallocate("order-1")
+
+    assert set(removed) == {OrderLine("order-1", "RED-CHAIR", 3), OrderLine("order-1", "RED-LAMP", 4)}
+    assert chair.available_quantity == 5
+    assert lamp.available_quantity == 10
+    assert index.orders_for("order-1") == []
+    assert index.deallocate("order-1") == []
+
+def test_index_reallocates_an_order_to_the_preferred_batch():
+    shipment = Batch("batch-001", "RED-CHAIR", 10, tomorrow)
+    shipment.allocate(OrderLine("order-1", "RED-CHAIR", 5))
+    warehouse = Batch("batch-002", "RED-CHAIR", 10, None)
+    index = AllocationIndex([shipment, warehouse])
+
+    assert index.reallocate("order-1") == ["batch-002"]
+    assert shipment.available_quantity == 10
+    assert warehouse.available_quantity == 5
+    assert index.orders_for("order-1") == ["batch-002"]
+
+def test_index_moves_a_batch_when_its_eta_changes():
+    warehouse = Batch("batch-001", "RED-CHAIR", 10, None)
+    early = Batch("batch-002", "RED-CHAIR", 10, tomorrow)
+    late = Batch("batch-003", "RED-CHAIR", 10, later)
+    index = AllocationIndex([late, warehouse, early])
+
+    index.update_eta("batch-003", None) # the late shipment arrived
+    index.update_eta("batch-001", later)
+
+    assert index.batches_for("RED-CHAIR") == [late, early, warehouse]
+    assert late.eta is None
+    assert index.allocate(OrderLine("order-1", "RED-CHAIR", 1)) == "batch-003"
+
+def test_index_keeps_allocation_order_through_inserts_updates_and_removals():
+    def expected_order(batches):
+        return [b.reference for b in sorted(batches)]
+
+    batches = [Batch(f"batch-{i}", "RED-CHAIR", 10, None if i % 5 == 0 else today + timedelta(days=i % 7)) for i in range(30)]
+    index = AllocationIndex(batches)
+    for i in range(30, 40):
+        batch = Batch(f"batch-{i}", "RED-CHAIR", 10, today + timedelta(days=i % 3))
+        batches.append(batch)
+        index.add(batch)
+    for i in range(0, 40, 3):
+        index.update_eta(f"batch-{i}", None if i % 2 else today + timedelta(days=i % 4))
+    for i in range(1, 40, 7):
+        batches.remove(index.remove(f"batch-{i}"))
+
+    assert [b.reference for b in index.batches_for("RED-CHAIR")] == expected_order(batches)
+
+def test_index_knows_each_allocation_once_after_a_batch_is_removed_and_added_back():
+    batch = Batch("batch-001", "RED-CHAIR", 10, None)
+    index = AllocationIndex([batch, Batch("batch-002", "RED-CHAIR", 10, tomorrow)])
+    index.allocate(OrderLine("order-1", "RED-CHAIR", 6))
+
+    index.add(index.remove("batch-001"))
+
+    assert index.deallocate("order-1") == [OrderLine("order-1", "RED-CHAIR", 6)]
+    index.allocate(OrderLine("order-2", "RED-CHAIR", 6))
+    index.add(index.remove("batch-001"))
+    assert index.reallocate("order-2") == ["batch-001"]
+    assert [b.allocated_quantity for b in index.batches_for("RED-CHAIR")] == [6, 0]
+
+def test_index_rejects_a_batch_it_already_holds():
+    batch = Batch("batch-001", "RED-CHAIR", 10, None)
+    index = AllocationIndex([batch])
+
+    with pytest.raises(ValueError, match="batch-001"):
+        index.add(Batch("batch-001", "RED-CHAIR", 5, None))
+
+def test_reducing_a_batch_quantity_deallocates_lines_that_no_longer_fit():
+    batch = Batch("batch-001", "RED-CHAIR", 20, None)
+    index = AllocationIndex([batch, Batch("batch-002", "RED-CHAIR", 20, tomorrow)])
+    for i in range(4):
+        index.allocate(OrderLine(f"order-{i}", "RED-CHAIR", 5))
+
+    deallocated = index.change_quantity("batch-001", 12)
+
+    assert deallocated == [OrderLine("order-3", "RED-CHAIR", 5), OrderLine("order-2", "RED-CHAIR", 5)]
+    assert batch.available_quantity == 2
+    assert [index.orders_for(line.orderid) for line in deallocated] == [[], []]
+    assert index.allocate_many(deallocated) == ["batch-002", "batch-002"]
+    assert index.change_quantity("batch-001", 30) == []
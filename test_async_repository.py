@@ -0,0 +1,72 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    create_async_engine,
+)
+
+from db_tables import metadata
+import model
+import respository
+
+
+async def make_engine(path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as connection:
+        await connection.run_sync(metadata.create_all)
+    return engine
+
+
+def test_async_repository_can_save_and_retrieve_a_batch(tmp_path):
+    async def scenario():
+        engine = await make_engine(tmp_path / "batches.db")
+        async with AsyncSession(engine) as session:
+            batch = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+            batch.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+            await respository.AsyncSqlRepository(session).add(batch)
+            await session.commit()
+
+        async with AsyncSession(engine) as session:
+            repo = respository.AsyncSqlRepository(session)
+            retrieved = await repo.get("batchref-1")
+            assert retrieved is await repo.get("batchref-1")
+            assert await repo.list("RED-CHAIR") == [retrieved]
+        await engine.dispose()
+        return retrieved
+
+    retrieved = asyncio.run(scenario())
+    assert retrieved.available_quantity == 90
+    assert retrieved._allocations == {model.OrderLine("orderid-1", "RED-CHAIR", 10)}
+
+def test_async_repository_serves_concurrent_requests(tmp_path):
+    async def allocate(engine, reference, orderid):
+        while True: # concurrent writers to the same batch conflict and retry from fresh reads
+            async with AsyncSession(engine) as session:
+                repo = respository.AsyncSqlRepository(session)
+                batch = await repo.get(reference)
+                batch.allocate(model.OrderLine(orderid, batch.sku, 1))
+                try:
+                    await repo.add(batch)
+                except respository.ConcurrentUpdateError:
+                    await session.rollback()
+                    continue
+                await session.commit()
+                return
+
+    async def scenario():
+        engine = await make_engine(tmp_path / "batches.db")
+        async with AsyncSession(engine) as session:
+            await respository.AsyncSqlRepository(session).add_all(
+                model.Batch(f"batchref-{i}", f"SKU-{i}", 100, None) for i in range(5)
+            )
+            await session.commit()
+
+        await asyncio.gather(*(allocate(engine, f"batchref-{i % 5}", f"orderid-{i}") for i in range(20)))
+
+        async with AsyncSession(engine) as session:
+            batches = await respository.AsyncSqlRepository(session).list()
+        await engine.dispose()
+        return batches
+
+    batches = asyncio.run(scenario())
+    assert [batch.available_quantity for batch in batches] == [96] * 5
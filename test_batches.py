@@ -1,4 +1,8 @@
+from dataclasses import dataclass
+from dataclasses import FrozenInstanceError
 from datetime import date
+import pickle
+import tracemalloc
 import pytest
 from typing import Tuple
 
@@ -42,3 +46,110 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+def test_deallocate_restores_available_quantity():
+    batch, line = make_batch_and_line("RED-CHAIR", 20, 2)
+    batch.allocate(line)
+    batch.deallocate(line)
+    batch.deallocate(line)
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+class IterationCountingSet(set):
+    """Set counting how many times it is iterated over, e.g. to re-sum its lines"""
+    iterations = 0
+
+    def __iter__(self):
+        self.iterations += 1
+        return super().__iter__()
+
+def test_allocation_cost_does_not_grow_with_batch_size():
+    batch = Batch("batch-001", "RED-CHAIR", 1_000_000, eta=None)
+    for i in range(20_000):
+        batch.allocate(OrderLine(f"order-{i}", batch.sku, 1))
+    batch._lines = IterationCountingSet(batch._lines)
+
+    for i in range(20_000, 21_000):
+        batch.allocate(OrderLine(f"order-{i}", batch.sku, 1))
+        assert batch.available_quantity == 1_000_000 - (i + 1)
+    batch.deallocate(OrderLine("order-0", batch.sku, 1))
+
+    assert batch.allocated_quantity == 20_999
+    # the running total is kept up to date instead of re-summing the allocations
+    assert batch._lines.iterations == 0
+
+
+def test_order_lines_are_immutable_and_picklable():
+    line = OrderLine("order-123", "RED-CHAIR", 2)
+    with pytest.raises(FrozenInstanceError):
+        line.qty = 3
+
+    copied = pickle.loads(pickle.dumps(line))
+    assert copied == line and hash(copied) == hash(line)
+
+def test_batches_keep_equality_hashing_and_ordering():
+    batch, line = make_batch_and_line("RED-CHAIR", 20, 2)
+    batch.allocate(line)
+    same_reference = Batch("batch-001", "BLUE-SOFA", 5, eta=None)
+
+    assert batch == same_reference and hash(batch) == hash(same_reference)
+    assert batch > same_reference
+    copied = pickle.loads(pickle.dumps(batch))
+    assert copied._allocations == {line} and copied.available_quantity == 18
+
+
+@dataclass(unsafe_hash=True)
+class DictOrderLine:
+    """The previous, __dict__ backed, representation of an order line"""
+    orderid: str
+    sku: str
+    qty: int
+
+class DictBatch(Batch):
+    """Subclassing without __slots__ brings back a per-instance __dict__"""
+
+def bytes_per_instance(factory, count: int = 10_000) -> float:
+    """Helper measuring the memory allocated per object created by `factory`"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [factory(i) for i in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(objects) == count
+    return (after - before) / count
+
+def test_slotted_representation_uses_less_memory():
+    orderids = [f"order-{i}" for i in range(10_000)] # shared strings, so only the objects are measured
+
+    slotted_line = bytes_per_instance(lambda i: OrderLine(orderids[i], "RED-CHAIR", 1))
+    dict_line = bytes_per_instance(lambda i: DictOrderLine(orderids[i], "RED-CHAIR", 1))
+    slotted_batch = bytes_per_instance(lambda i: Batch(orderids[i], "RED-CHAIR", 10, None))
+    dict_batch = bytes_per_instance(lambda i: DictBatch(orderids[i], "RED-CHAIR", 10, None))
+
+    assert slotted_line < dict_line * 0.75
+    assert slotted_batch < dict_batch
+
+def test_deferred_allocations_are_loaded_once_on_first_access():
+    lines = [OrderLine("order-1", "RED-CHAIR", 3), OrderLine("order-2", "RED-CHAIR", 4)]
+    loads = []
+    batch = Batch("batch-001", "RED-CHAIR", 20, None)
+    batch.defer_allocations(lambda: loads.append(1) or lines, allocated_quantity=7)
+
+    assert batch.available_quantity == 13
+    assert loads == []
+    batch.allocate(OrderLine("order-3", "RED-CHAIR", 5))
+    assert batch._allocations == set(lines) | {OrderLine("order-3", "RED-CHAIR", 5)}
+    assert batch.available_quantity == 8
+    assert loads == [1]
+
+def test_deferred_allocations_are_loaded_before_pickling():
+    batch = Batch("batch-001", "RED-CHAIR", 20, None)
+    batch.defer_allocations(lambda: [OrderLine("order-1", "RED-CHAIR", 3)], allocated_quantity=3)
+
+    copy = pickle.loads(pickle.dumps(batch))
+
+    assert copy._allocations == {OrderLine("order-1", "RED-CHAIR", 3)}
+    assert copy.available_quantity == 17
@@ -0,0 +1,33 @@
+import benchmark
+
+
+def test_generated_inventory_has_the_requested_shape():
+    spec = benchmark.InventorySpec(skus=3, batches_per_sku=4, lines_per_batch=5, eta_spread_days=2)
+    batches, lines = benchmark.generate_inventory(spec)
+
+    assert len(batches) == 12
+    assert len({batch.sku for batch in batches}) == 3
+    assert all(len(batch._allocations) == 5 for batch in batches)
+    assert len(lines) == 60
+    assert benchmark.generate_inventory(spec)[1] == lines
+
+def test_benchmark_suite_reports_every_path(tmp_path):
+    results = benchmark.run(benchmark.InventorySpec(skus=2, batches_per_sku=2, lines_per_batch=3))
+
+    names = [result.name for result in results]
+    assert "model.allocate" in names and "Batch.allocate" in names
+    assert "model.allocate_many" in names and "parallel.allocate_in_parallel" in names
+    assert "SqlRepository.get [sqlite memory]" in names and "SqlRepository.list [sqlite file]" in names
+    assert all(r.ops_per_sec > 0 and r.p50_ms <= r.p99_ms and r.peak_memory_kb >= 0 for r in results)
+
+    baseline = tmp_path / "baseline.json"
+    benchmark.save_baseline(results, str(baseline))
+    assert benchmark.load_baseline(str(baseline)) == results
+
+def test_regressions_are_reported_against_the_baseline():
+    baseline = [benchmark.BenchmarkResult("model.allocate", 10, 1000.0, 1.0, 2.0, 10.0)]
+    slower = [benchmark.BenchmarkResult("model.allocate", 10, 700.0, 1.4, 2.8, 10.0)]
+    similar = [benchmark.BenchmarkResult("model.allocate", 10, 900.0, 1.1, 2.2, 10.0)]
+
+    assert len(benchmark.compare(slower, baseline, tolerance=0.25)) == 1
+    assert benchmark.compare(similar, baseline, tolerance=0.25) == []
@@ -0,0 +1,77 @@
+from datetime import (
+    date,
+    timedelta,
+)
+import random
+
+from columnar import ColumnarAllocator
+from model import (
+    allocate,
+    Batch,
+    OrderLine,
+    OutOfStock,
+)
+
+
+today = date.today()
+
+
+def make_inventory(seed: int):
+    rng = random.Random(seed)
+    batches = [
+        Batch(f"batch-{i}", f"SKU-{rng.randrange(8)}", rng.randrange(0, 40), rng.choice([None, today + timedelta(days=rng.randrange(5))]))
+        for i in range(80)
+    ]
+    lines = [OrderLine(f"order-{rng.randrange(300)}", f"SKU-{rng.randrange(9)}", rng.randrange(1, 12)) for _ in range(600)]
+    return batches, lines
+
+def allocate_sequentially(lines, batches):
+    results = []
+    for line in lines:
+        try:
+            results.append(allocate(line, batches))
+        except OutOfStock:
+            results.append(None)
+    return results
+
+
+def test_columnar_allocation_matches_sequential_allocate():
+    for seed in range(5):
+        batches, lines = make_inventory(seed)
+        expected = allocate_sequentially(lines, batches)
+
+        fresh_batches, _ = make_inventory(seed)
+        allocator = ColumnarAllocator(fresh_batches)
+        assert allocator.allocate(lines) == expected
+
+        exported = {batch.reference: batch for batch in allocator.to_batches()}
+        for batch in batches:
+            assert exported[batch.reference]._allocations == batch._allocations
+            assert exported[batch.reference].eta == batch.eta
+
+def test_columnar_allocation_respects_existing_allocations():
+    warehouse = Batch("batch-001", "RED-CHAIR", 10, None)
+    warehouse.allocate(OrderLine("order-0", "RED-CHAIR", 8))
+    warehouse.version_number = 3 # as read from the database
+    shipment = Batch("batch-002", "RED-CHAIR", 10, today)
+    allocator = ColumnarAllocator([shipment, warehouse])
+
+    results = allocator.allocate([
+        OrderLine("order-1", "RED-CHAIR", 2),
+        OrderLine("order-2", "RED-CHAIR", 2),
+        OrderLine("order-2", "RED-CHAIR", 2),
+        OrderLine("order-3", "BLUE-SOFA", 1),
+    ])
+
+    assert results == ["batch-001", "batch-002", "batch-002", None]
+    assert list(allocator.remaining) == [0, 8]
+    assert [batch.version_number for batch in allocator.to_batches()] == [3, None]
+
+def test_columnar_assignments_can_be_applied_back_onto_batches():
+    batches = [Batch("batch-001", "RED-CHAIR", 10, None), Batch("batch-002", "RED-LAMP", 10, today)]
+    allocator = ColumnarAllocator(batches)
+    allocator.allocate([OrderLine("order-1", "RED-LAMP", 4), OrderLine("order-2", "RED-CHAIR", 3)])
+
+    allocator.apply(batches)
+
+    assert [b.available_quantity for b in batches] == [7, 6]
@@ -0,0 +1,115 @@
+import pickle
+
+import pytest
+from sqlalchemy.event import listen
+
+from eventlog import AllocationEventLog
+from eventlog import JsonlEventSink
+from eventlog import rebuild
+from eventlog import SqlEventSink
+import events
+import model
+import respository
+import services
+import unit_of_work
+
+
+class FailingSink(JsonlEventSink):
+    def write(self, new_events):
+        raise OSError("disk full")
+
+
+def test_batches_raise_allocated_and_deallocated_events():
+    batch = model.Batch("batch-001", "RED-CHAIR", 10, None)
+    line = model.OrderLine("order-1", "RED-CHAIR", 2)
+    batch.record_events()
+
+    batch.allocate(line)
+    batch.allocate(line) # idempotent, so no second event
+    batch.deallocate(line)
+    batch.deallocate(line)
+
+    assert batch.events == [
+        events.Allocated("order-1", "RED-CHAIR", 2, "batch-001"),
+        events.Deallocated("order-1", "RED-CHAIR", 2, "batch-001"),
+    ]
+    assert pickle.loads(pickle.dumps(batch)).events is None
+
+def test_batches_only_record_events_when_asked_to():
+    batches = [model.Batch(f"batch-{i}", "RED-CHAIR", 10, None) for i in range(3)]
+    model.allocate_many([model.OrderLine(f"order-{i}", "RED-CHAIR", 1) for i in range(30)], batches)
+
+    assert [batch.events for batch in batches] == [None, None, None]
+
+def test_loaded_batches_have_no_events(session):
+    batch = model.Batch("batch-001", "RED-CHAIR", 10, None)
+    batch.allocate(model.OrderLine("order-1", "RED-CHAIR", 2))
+    respository.SqlRepository(session).add(batch)
+
+    [listed] = respository.SqlRepository(session, record_events=True).list()
+    assert listed.events == []
+
+def test_log_writes_buffered_events_in_bulk(in_memory_db):
+    statements = []
+    listen(in_memory_db, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    log = AllocationEventLog(SqlEventSink(in_memory_db), buffer_size=3)
+
+    log.record([events.Allocated(f"order-{i}", "RED-CHAIR", 1, "batch-001") for i in range(2)])
+    assert (log.pending, statements) == (2, [])
+    log.record([events.OutOfStock("order-2", "RED-CHAIR", 50)])
+
+    assert log.pending == 0
+    assert len(statements) == 1
+    assert list(SqlEventSink(in_memory_db).read()) == [
+        events.Allocated("order-0", "RED-CHAIR", 1, "batch-001"),
+        events.Allocated("order-1", "RED-CHAIR", 1, "batch-001"),
+        events.OutOfStock("order-2", "RED-CHAIR", 50),
+    ]
+
+def test_failed_writes_keep_events_buffered(tmp_path):
+    log = AllocationEventLog(FailingSink(str(tmp_path / "events.jsonl")))
+    log.record([events.Allocated("order-1", "RED-CHAIR", 1, "batch-001")])
+
+    with pytest.raises(OSError):
+        log.flush()
+    assert log.pending == 1
+
+    log.sink = JsonlEventSink(str(tmp_path / "events.jsonl"))
+    assert log.flush() == 1
+    assert list(log.sink.read()) == [events.Allocated("order-1", "RED-CHAIR", 1, "batch-001")]
+
+def test_batches_can_be_rebuilt_from_the_log(tmp_path):
+    def definitions():
+        return [model.Batch("batch-001", "RED-CHAIR", 20, None), model.Batch("batch-002", "RED-CHAIR", 20, None)]
+    batches = definitions()
+    for batch in batches:
+        batch.record_events()
+    index = model.AllocationIndex(batches)
+    for i in range(15):
+        index.allocate(model.OrderLine(f"order-{i}", "RED-CHAIR", 2))
+    index.deallocate("order-3")
+
+    with AllocationEventLog(JsonlEventSink(str(tmp_path / "events.jsonl"))) as log:
+        log.collect(batches)
+    rebuilt = rebuild(definitions(), log.sink.read())
+
+    assert [b._allocations for b in rebuilt] == [b._allocations for b in batches]
+    assert [b.available_quantity for b in rebuilt] == [b.available_quantity for b in batches]
+    assert all(not b.events for b in rebuilt + batches)
+
+def test_unit_of_work_logs_the_events_of_committed_allocations(session_factory, tmp_path):
+    session = session_factory()
+    respository.SqlRepository(session).add(model.Batch("batch-001", "RED-CHAIR", 10, None))
+    session.commit()
+    log = AllocationEventLog(JsonlEventSink(str(tmp_path / "events.jsonl")))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, event_log=log)
+
+    services.allocate(model.OrderLine("order-1", "RED-CHAIR", 8), uow)
+    with pytest.raises(model.OutOfStock):
+        services.allocate(model.OrderLine("order-2", "RED-CHAIR", 8), uow)
+    log.flush()
+
+    assert list(log.sink.read()) == [
+        events.Allocated("order-1", "RED-CHAIR", 8, "batch-001"),
+        events.OutOfStock("order-2", "RED-CHAIR", 8),
+    ]
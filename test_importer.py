@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+import importer
+import model
+import respository
+
+
+def write_csv(path, header, rows):
+    path.write_text("\n".join([",".join(header)] + [",".join(map(str, row)) for row in rows]) + "\n")
+    return str(path)
+
+def write_jsonl(path, rows):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    return str(path)
+
+
+def test_imports_batches_and_allocations_in_chunks(tmp_path, session_factory):
+    batches = write_csv(
+        tmp_path / "batches.csv",
+        ["reference", "sku", "qty", "eta"],
+        [("batch1", "RED-CHAIR", 100, ""), ("batch2", "RED-CHAIR", 50, "2022-06-01"), ("batch3", "BLUE-SOFA", 10, "")],
+    )
+    allocations = write_jsonl(
+        tmp_path / "allocations.jsonl",
+        [
+            dict(orderid="order1", sku="RED-CHAIR", qty=10, batch="batch1"),
+            dict(orderid="order1", sku="BLUE-SOFA", qty=2, batch="batch3"),
+            dict(orderid="order2", sku="RED-CHAIR", qty=5, batch="batch2"),
+            dict(orderid="order3", sku="RED-CHAIR", qty=5, batch="batch1"),
+            dict(orderid="order4", sku="BLUE-SOFA", qty=8, batch="batch3"),
+        ],
+    )
+    progress = []
+
+    batch_report = importer.import_batches(session_factory, batches, chunk_size=2)
+    allocation_report = importer.import_allocations(session_factory, allocations, chunk_size=2, progress=progress.append)
+
+    assert (batch_report.rows, batch_report.chunks) == (3, 2)
+    assert (allocation_report.rows, allocation_report.chunks) == (5, 3)
+    assert [report.rows for report in progress] == [2, 4, 5]
+    assert allocation_report.rows_per_second > 0
+    listed = {b.reference: b for b in respository.SqlRepository(session_factory()).list()}
+    assert [listed[ref].available_quantity for ref in ("batch1", "batch2", "batch3")] == [85, 45, 0]
+    assert str(listed["batch2"].eta) == "2022-06-01"
+    stored = session_factory().execute("SELECT reference, allocated_quantity FROM batches ORDER BY id")
+    assert list(stored) == [("batch1", 15), ("batch2", 5), ("batch3", 10)]
+
+def test_repeated_allocations_are_skipped_within_a_file_and_across_imports(tmp_path, session_factory):
+    importer.import_batches(session_factory, write_jsonl(tmp_path / "batches.jsonl", [dict(reference="batch1", sku="RED-CHAIR", qty=10)]))
+    line = dict(orderid="order1", sku="RED-CHAIR", qty=6, batch="batch1")
+    allocations = write_jsonl(tmp_path / "allocations.jsonl", [line, dict(line, orderid="order2", qty=2), line])
+
+    first = importer.import_allocations(session_factory, allocations, chunk_size=2)
+    again = importer.import_allocations(session_factory, allocations)
+
+    assert (first.rows, first.skipped) == (3, 1)
+    assert (again.rows, again.skipped) == (3, 3)
+    repo = respository.SqlRepository(session_factory())
+    assert repo.available_quantities() == {"RED-CHAIR": 2}
+    assert repo.get("batch1")._allocations == {model.OrderLine("order1", "RED-CHAIR", 6), model.OrderLine("order2", "RED-CHAIR", 2)}
+    assert list(session_factory().execute("SELECT COUNT(*) FROM order_lines")) == [(2,)]
+
+def test_batches_already_stored_are_skipped(tmp_path, session_factory):
+    first = write_jsonl(tmp_path / "first.jsonl", [dict(reference="batch1", sku="RED-CHAIR", qty=10)])
+    second = write_jsonl(
+        tmp_path / "second.jsonl",
+        [dict(reference="batch1", sku="RED-CHAIR", qty=99), dict(reference="batch2", sku="BLUE-SOFA", qty=5)],
+    )
+    importer.import_batches(session_factory, first)
+
+    report = importer.import_batches(session_factory, second)
+
+    assert (report.rows, report.skipped) == (2, 1)
+    assert respository.SqlRepository(session_factory()).available_quantities() == {"RED-CHAIR": 10, "BLUE-SOFA": 5}
+
+def test_importing_the_same_batches_twice_from_the_command_line_succeeds(tmp_path, capsys):
+    path = write_jsonl(tmp_path / "batches.jsonl", [dict(reference="batch1", sku="RED-CHAIR", qty=10)])
+    argv = ["batches", path, "--database-url", f"sqlite:///{tmp_path / 'allocation.db'}"]
+
+    assert importer.main(argv) == 0
+    assert importer.main(argv) == 0
+    assert "skipped 1 rows that were already imported" in capsys.readouterr().out
+
+@pytest.mark.parametrize("row, reason", [
+    (dict(reference="", sku="RED-CHAIR", qty=1), "missing `reference`"),
+    (dict(reference="batch1", sku="RED-CHAIR", qty="ten"), "`qty` is not a whole number"),
+    (dict(reference="batch1", sku="RED-CHAIR", qty=-1), "`qty` must be at least 0"),
+    (dict(reference="batch1", sku="RED-CHAIR", qty=1, eta="June"), "`eta` is not an ISO date"),
+    (dict(reference="batch0", sku="RED-CHAIR", qty=2), "batch `batch0` is already on line 1"),
+])
+def test_invalid_batch_rows_are_reported_with_their_line(tmp_path, session_factory, row, reason):
+    path = write_jsonl(tmp_path / "batches.jsonl", [dict(reference="batch0", sku="RED-CHAIR", qty=1), row])
+
+    with pytest.raises(importer.InvalidRow, match=reason) as error:
+        importer.import_batches(session_factory, path)
+    assert error.value.line_number == 2
+
+@pytest.mark.parametrize("row, reason", [
+    (dict(orderid="order1", sku="RED-CHAIR", qty=1, batch="nope"), "unknown batch `nope`"),
+    (dict(orderid="order1", sku="BLUE-SOFA", qty=1, batch="batch1"), "holds `RED-CHAIR`, not `BLUE-SOFA`"),
+    (dict(orderid="order1", sku="RED-CHAIR", qty=11, batch="batch1"), "has only 10 left"),
+])
+def test_invalid_allocation_rows_are_rejected(tmp_path, session_factory, row, reason):
+    importer.import_batches(session_factory, write_jsonl(tmp_path / "batches.jsonl", [dict(reference="batch1", sku="RED-CHAIR", qty=10)]))
+
+    with pytest.raises(importer.InvalidRow, match=reason):
+        importer.import_allocations(session_factory, write_jsonl(tmp_path / "allocations.jsonl", [row]))
+    assert list(session_factory().execute("SELECT COUNT(*) FROM allocations")) == [(0,)]
@@ -0,0 +1,58 @@
+from datetime import date
+
+from instrumentation import RepositoryMetrics
+import model
+import respository
+
+
+def make_batches(count: int, lines_per_batch: int):
+    batches = []
+    for i in range(count):
+        batch = model.Batch(f"batchref-{i}", "RED-CHAIR", 100, None)
+        for j in range(lines_per_batch):
+            batch.allocate(model.OrderLine(f"orderid-{i}-{j}", "RED-CHAIR", 1))
+        batches.append(batch)
+    return batches
+
+
+def test_metrics_count_statements_and_rows_per_call(session):
+    calls = []
+    metrics = RepositoryMetrics(callbacks=[calls.append])
+    repo = respository.SqlRepository(session, metrics=metrics)
+
+    repo.add_all(make_batches(3, lines_per_batch=4))
+    [add_all] = calls
+    assert add_all.method == "add_all"
+    assert add_all.rows_written == 3 + 12 + 12 # batches, order lines, allocations
+    assert add_all.statements < 10
+    assert add_all.wall_time > 0
+
+    respository.SqlRepository(session, metrics=metrics).list()
+    listed = calls[-1]
+    assert (listed.method, listed.statements, listed.rows_read) == ("list", 1, 12)
+    assert 0 < listed.hydration_time <= listed.wall_time
+
+def test_nested_calls_are_recorded_once_under_the_outer_method(session):
+    metrics = RepositoryMetrics()
+    repo = respository.SqlRepository(session, metrics=metrics)
+
+    repo.add(model.Batch("batchref-1", "RED-CHAIR", 100, date(2022, 6, 1)))
+    repo.get("batchref-1")
+
+    assert metrics.calls == {"add": 1, "get": 1}
+    assert metrics.totals["get"].statements == 0 # served from the identity map
+
+def test_streaming_is_recorded_when_the_iteration_finishes(session):
+    respository.SqlRepository(session).add_all(make_batches(5, lines_per_batch=2))
+    calls = []
+    repo = respository.SqlRepository(session, metrics=RepositoryMetrics(callbacks=[calls.append]))
+
+    batches = repo.iter_batches(chunk_size=2)
+    next(batches)
+    repo.get("batchref-4") # a call made while streaming is recorded on its own
+    rest = list(batches)
+
+    assert len(rest) == 4
+    assert [call.method for call in calls] == ["get", "iter_batches"]
+    assert calls[-1].statements == 7 # 3 chunks of (ids, rows) plus the final empty page
+    assert calls[-1].rows_read == 5 + 10
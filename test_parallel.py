@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import (
+    date,
+    timedelta,
+)
+import random
+
+from model import (
+    allocate_many,
+    Batch,
+    OrderLine,
+)
+from parallel import (
+    allocate_in_parallel,
+    make_shards,
+)
+
+
+today = date.today()
+
+
+def make_inventory():
+    rng = random.Random(42)
+    batches = [
+        Batch(f"batch-{i}", f"SKU-{rng.randrange(12)}", rng.randrange(0, 50), rng.choice([None, today + timedelta(days=rng.randrange(7))]))
+        for i in range(120)
+    ]
+    lines = [OrderLine(f"order-{i}", f"SKU-{rng.randrange(13)}", rng.randrange(1, 10)) for i in range(1_000)]
+    return batches, lines
+
+
+def test_shards_never_share_a_sku():
+    batches, lines = make_inventory()
+    shards = make_shards(lines, batches, 4)
+
+    assert len(shards) == 4
+    skus_per_shard = [{line.sku for line in shard_lines} for _, (_, shard_lines) in shards]
+    assert sum(len(skus) for skus in skus_per_shard) == len(set().union(*skus_per_shard))
+    assert sorted(p for positions, _ in shards for p in positions) == list(range(len(lines)))
+    assert make_shards(lines, batches, 4) == shards
+
+def test_parallel_allocation_matches_bulk_allocation():
+    batches, lines = make_inventory()
+    expected = allocate_many(lines, batches)
+
+    parallel_batches, _ = make_inventory()
+    assert allocate_in_parallel(lines, parallel_batches, max_workers=3) == expected
+    assert [b._allocations for b in parallel_batches] == [b._allocations for b in batches]
+    assert [b.available_quantity for b in parallel_batches] == [b.available_quantity for b in batches]
+
+def test_parallel_allocation_raises_events_on_batches_recording_them():
+    batches, lines = make_inventory()
+    for batch in batches:
+        batch.record_events()
+
+    results = allocate_in_parallel(lines, batches, max_workers=3)
+
+    allocated = sorted((e.batchref, e.orderid) for batch in batches for e in batch.events)
+    assert allocated == sorted((reference, line.orderid) for line, reference in zip(lines, results) if reference)
+
+def test_parallel_allocation_accepts_another_executor():
+    batches, lines = make_inventory()
+    expected = allocate_many(lines, make_inventory()[0])
+
+    assert allocate_in_parallel(lines, batches, max_workers=2, executor_factory=ThreadPoolExecutor) == expected
@@ -2,7 +2,11 @@ from datetime import (
     date,
     timedelta,
 )
+
 import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
 
 import model
 import respository
@@ -32,7 +36,7 @@ def insert_batch(session, batch: model.Batch) -> str:
     session.execute(
         "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
         ' VALUES (:reference, :sku, :qty, :eta)',
-        dict(reference=batch.reference, sku=batch.sku, qty=batch._purchased_quantity, eta=batch.eta or "null"),
+        dict(reference=batch.reference, sku=batch.sku, qty=batch._purchased_quantity, eta=batch.eta),
     )
     [[batch_id]] = session.execute(
         "SELECT id FROM batches WHERE reference=:reference AND sku=:sku",
@@ -171,3 +175,436 @@ def test_repository_can_retrieve_all_batches(session):
     assert b2.sku == "YELLOW-CHAIR"
     assert b2._purchased_quantity == 100
     assert b2._allocations == set()
+
+
+def count_statements(engine):
+    """Helper to record every statement sent to the database"""
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    return statements
+
+def test_saving_a_batch_with_many_allocations_uses_a_constant_number_of_statements(session, in_memory_db):
+    batch = model.Batch("batchref-1", "RED-CHAIR", 10_000, None)
+    for i in range(2_000):
+        batch.allocate(model.OrderLine(f"orderid-{i}", "RED-CHAIR", 1))
+
+    statements = count_statements(in_memory_db)
+    respository.SqlRepository(session).add(batch)
+    session.commit()
+
+    assert len(statements) < 10
+    assert len(get_allocations(session, "batchref-1")) == 2_000
+
+def test_repository_can_save_many_batches_at_once(session):
+    existing = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    existing.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    repo = respository.SqlRepository(session)
+    repo.add(existing)
+    session.commit()
+
+    existing.allocate(model.OrderLine("orderid-2", "RED-CHAIR", 10))
+    new = model.Batch("batchref-2", "BLUE-SOFA", 50, tomorrow)
+    new.allocate(model.OrderLine("orderid-1", "BLUE-SOFA", 5))
+    new.allocate(model.OrderLine("orderid-3", "BLUE-SOFA", 5))
+    repo.add_all([existing, new])
+    session.commit()
+
+    rows = session.execute("SELECT reference, sku, _purchased_quantity FROM 'batches' ORDER BY id")
+    assert list(rows) == [("batchref-1", "RED-CHAIR", 100), ("batchref-2", "BLUE-SOFA", 50)]
+    assert get_allocations(session, "batchref-1") == {"orderid-1", "orderid-2"}
+    assert get_allocations(session, "batchref-2") == {"orderid-1", "orderid-3"}
+
+def test_listing_batches_uses_a_single_query_and_can_filter_by_sku(session, in_memory_db):
+    repo = respository.SqlRepository(session)
+    chairs = [model.Batch(f"chair-{i}", "RED-CHAIR", 100, None) for i in range(20)]
+    for i, batch in enumerate(chairs):
+        batch.allocate(model.OrderLine(f"orderid-{i}", "RED-CHAIR", 10))
+    sofa = model.Batch("sofa-1", "BLUE-SOFA", 100, tomorrow)
+    repo.add_all(chairs + [sofa])
+    session.commit()
+
+    statements = count_statements(in_memory_db)
+    listed = repo.list(sku="RED-CHAIR")
+
+    assert len(statements) == 1
+    assert listed == chairs
+    assert [b._allocations for b in listed] == [b._allocations for b in chairs]
+    assert repo.list(sku="BLUE-SOFA") == [sofa]
+
+def test_allocated_quantity_is_stored_on_the_batch_row(session):
+    repo = respository.SqlRepository(session)
+    batch = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    batch.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    repo.add(batch)
+    batch.allocate(model.OrderLine("orderid-2", "RED-CHAIR", 5))
+    batch.deallocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    repo.add(batch)
+    session.commit()
+
+    assert list(session.execute("SELECT allocated_quantity FROM batches")) == [(5,)]
+
+def test_available_quantities_are_summed_per_sku_from_the_batches_table(session, in_memory_db):
+    repo = respository.SqlRepository(session)
+    chair = model.Batch("chair-1", "RED-CHAIR", 100, None)
+    chair.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    repo.add_all([chair, model.Batch("chair-2", "RED-CHAIR", 20, tomorrow), model.Batch("lamp-1", "RED-LAMP", 5, None)])
+    session.commit()
+
+    statements = count_statements(in_memory_db)
+    available = repo.available_quantities()
+
+    assert available == {"RED-CHAIR": 110, "RED-LAMP": 5}
+    assert len(statements) == 1
+    assert "order_lines" not in statements[0] and "allocations" not in statements[0]
+    assert repo.available_quantities(["RED-LAMP", "BLUE-SOFA"]) == {"RED-LAMP": 5, "BLUE-SOFA": 0}
+
+def test_batches_for_an_order_are_found_in_a_single_query(session, in_memory_db):
+    repo = respository.SqlRepository(session)
+    chair = model.Batch("chair-1", "RED-CHAIR", 100, None)
+    chair.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    lamp = model.Batch("lamp-1", "RED-LAMP", 100, None)
+    lamp.allocate(model.OrderLine("orderid-1", "RED-LAMP", 1))
+    lamp.allocate(model.OrderLine("orderid-2", "RED-LAMP", 1))
+    other = model.Batch("lamp-2", "RED-LAMP", 100, None)
+    other.allocate(model.OrderLine("orderid-2", "RED-LAMP", 2))
+    repo.add_all([chair, lamp, other])
+    session.commit()
+
+    statements = count_statements(in_memory_db)
+    found = respository.SqlRepository(session).for_order("orderid-1")
+
+    assert len(statements) == 1
+    assert found == [chair, lamp]
+    assert [b._allocations for b in found] == [chair._allocations, lamp._allocations]
+    assert respository.SqlRepository(session).for_order("orderid-3") == []
+
+def test_iterating_batches_streams_them_in_chunks(session, in_memory_db):
+    repo = respository.SqlRepository(session)
+    chairs = [model.Batch(f"chair-{i}", "RED-CHAIR", 100, None) for i in range(25)]
+    for i, batch in enumerate(chairs):
+        for j in range(i % 4):
+            batch.allocate(model.OrderLine(f"orderid-{i}-{j}", "RED-CHAIR", 5))
+    sofas = [model.Batch(f"sofa-{i}", "BLUE-SOFA", 100, tomorrow) for i in range(5)]
+    repo.add_all(chairs + sofas)
+    session.commit()
+
+    statements = count_statements(in_memory_db)
+    streamed = list(repo.iter_batches(chunk_size=10, sku="RED-CHAIR"))
+
+    assert streamed == chairs
+    assert [b._allocations for b in streamed] == [b._allocations for b in chairs]
+    assert len(statements) == 7 # 3 chunks of (ids, rows) plus the final empty page
+    assert list(repo.iter_batches(chunk_size=2)) == chairs + sofas
+
+
+def test_repository_returns_the_same_batch_instance_within_a_session(session, in_memory_db):
+    repo = respository.SqlRepository(session)
+    repo.add(model.Batch("batchref-1", "RED-CHAIR", 100, None))
+    session.commit()
+
+    statements = count_statements(in_memory_db)
+    first = repo.get("batchref-1")
+    second = repo.get("batchref-1")
+    [listed] = repo.list()
+
+    assert first is second is listed
+    assert len(statements) == 1 # only list hits the database: the added batch is already tracked
+
+def test_fetched_batch_is_shared_between_get_and_list(session):
+    insert_batch(session, model.Batch("batchref-1", "RED-CHAIR", 100, tomorrow))
+    repo = respository.SqlRepository(session)
+
+    [listed] = repo.list()
+    assert repo.get("batchref-1") is listed
+
+def test_get_loads_allocations_only_when_they_are_accessed(session, in_memory_db):
+    batch = model.Batch("batchref-1", "RED-CHAIR", 100, tomorrow)
+    for i in range(50):
+        batch.allocate(model.OrderLine(f"orderid-{i}", "RED-CHAIR", 1))
+    respository.SqlRepository(session).add(batch)
+    session.commit()
+
+    repo = respository.SqlRepository(session)
+    statements = count_statements(in_memory_db)
+    retrieved = repo.get("batchref-1")
+
+    assert (retrieved.sku, retrieved._purchased_quantity, retrieved.available_quantity) == ("RED-CHAIR", 100, 50)
+    assert len(statements) == 1 and "order_lines" not in statements[0]
+    repo.add(retrieved) # nothing to write: the allocations were never loaded
+    assert len(statements) == 1
+
+    assert retrieved._allocations == batch._allocations
+    assert len(statements) == 2
+    retrieved.allocate(model.OrderLine("orderid-50", "RED-CHAIR", 1))
+    repo.add(retrieved)
+    session.commit()
+    assert len(get_allocations(session, "batchref-1")) == 51
+
+def test_order_line_ids_never_come_from_rows_another_writer_inserted(session):
+    line = model.OrderLine("orderid-1", "RED-CHAIR", 10)
+
+    def execute(statement, params=None):
+        rows = list(session.execute(statement, params))
+        if statement is respository.MAX_ORDER_LINE_ID:
+            insert_order_line(session, line) # another writer gets in before the insert
+        return rows
+
+    with pytest.raises(IntegrityError):
+        respository.insert_order_lines(execute, session.get_bind().dialect, [line])
+
+def test_lazy_batches_check_stock_against_their_loaded_lines(session):
+    batch_id = insert_batch(session, model.Batch("batchref-1", "RED-CHAIR", 10, None))
+    insert_allocation(session, insert_order_line(session, model.OrderLine("orderid-1", "RED-CHAIR", 8)), batch_id)
+    # written without updating the stored total, which still says nothing is allocated
+
+    repo = respository.SqlRepository(session)
+    batch = repo.get("batchref-1")
+    batch.allocate(model.OrderLine("orderid-2", "RED-CHAIR", 5))
+    repo.add(batch)
+
+    assert batch.allocated_quantity == 8
+    assert get_allocations(session, "batchref-1") == {"orderid-1"}
+
+def test_saving_a_tracked_batch_only_writes_the_changes(session, in_memory_db):
+    ol1 = model.OrderLine("orderid-1", "RED-CHAIR", 10)
+    ol2 = model.OrderLine("orderid-2", "RED-CHAIR", 20)
+    repo = respository.SqlRepository(session)
+    batch = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    batch.allocate(ol1)
+    repo.add(batch)
+    session.commit()
+
+    statements = count_statements(in_memory_db)
+    batch = repo.get("batchref-1")
+    batch.deallocate(ol1)
+    batch.allocate(ol2)
+    repo.add(batch)
+    session.commit()
+
+    assert not any("reference IN" in s or "allocations.batch_id IN" in s for s in statements)
+    assert get_allocations(session, "batchref-1") == {"orderid-2"}
+    assert list(session.execute("SELECT orderid FROM order_lines")) == [("orderid-2",)]
+
+def test_saving_a_batch_never_read_keeps_lines_it_does_not_hold(session):
+    ol1 = model.OrderLine("orderid-1", "RED-CHAIR", 10)
+    ol2 = model.OrderLine("orderid-2", "RED-CHAIR", 20)
+    batch = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    batch.allocate(ol1)
+    respository.SqlRepository(session).add(batch)
+    session.commit()
+
+    unread = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    unread.allocate(ol2)
+    respository.SqlRepository(session).add(unread)
+    session.commit()
+
+    assert get_allocations(session, "batchref-1") == {"orderid-1", "orderid-2"}
+    assert unread._allocations == {ol1, ol2}
+
+def test_saving_a_copy_read_before_another_write_raises(session_factory):
+    session = session_factory()
+    respository.SqlRepository(session).add(model.Batch("batchref-1", "RED-CHAIR", 10, None))
+    session.commit()
+    [first] = respository.SqlRepository(session_factory()).iter_batches()
+    [second] = respository.SqlRepository(session_factory()).iter_batches()
+
+    first.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 6))
+    respository.SqlRepository(session).add(first)
+    session.commit()
+    second.allocate(model.OrderLine("orderid-2", "RED-CHAIR", 6))
+    with pytest.raises(respository.ConcurrentUpdateError):
+        respository.SqlRepository(session).add(second)
+    session.rollback()
+
+    assert get_allocations(session, "batchref-1") == {"orderid-1"}
+
+def test_stored_allocations_are_loaded_and_saved_back_as_they_are(session):
+    batch_id = insert_batch(session, model.Batch("batchref-1", "RED-CHAIR", 10, None))
+    for orderid in ("orderid-1", "orderid-2"): # more than the batch can hold
+        insert_allocation(session, insert_order_line(session, model.OrderLine(orderid, "RED-CHAIR", 6)), batch_id)
+
+    repo = respository.SqlRepository(session)
+    [batch] = repo.list()
+    repo.flush()
+    session.commit()
+
+    assert batch.allocated_quantity == 12
+    assert get_allocations(session, "batchref-1") == {"orderid-1", "orderid-2"}
+
+def test_unchanged_tracked_batch_is_not_written(session, in_memory_db):
+    repo = respository.SqlRepository(session)
+    batch = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    batch.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    repo.add(batch)
+
+    statements = count_statements(in_memory_db)
+    repo.add(batch)
+
+    assert statements == []
+
+
+def test_cached_repository_serves_repeat_reads_across_sessions(session, in_memory_db):
+    batch = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    batch.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    respository.SqlRepository(session).add(batch)
+    session.commit()
+    cache = respository.BatchCache()
+
+    first = respository.CachingRepository(respository.SqlRepository(session), cache).get("batchref-1")
+    statements = count_statements(in_memory_db)
+    second_repo = respository.CachingRepository(respository.SqlRepository(session), cache)
+    second = second_repo.get("batchref-1")
+
+    assert statements == []
+    assert second is not first
+    assert second is second_repo.get("batchref-1")
+    assert second._allocations == first._allocations
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_adding_through_the_cache_invalidates_cached_reads(session):
+    cache = respository.BatchCache()
+    repo = respository.CachingRepository(respository.SqlRepository(session), cache)
+    repo.add(model.Batch("batchref-1", "RED-CHAIR", 100, None))
+    assert [b.available_quantity for b in repo.list("RED-CHAIR")] == [100]
+
+    next_repo = respository.CachingRepository(respository.SqlRepository(session), cache)
+    batch = next_repo.get("batchref-1")
+    batch.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    next_repo.add(batch)
+
+    last_repo = respository.CachingRepository(respository.SqlRepository(session), cache)
+    assert last_repo.get("batchref-1").available_quantity == 90
+    assert [b.available_quantity for b in last_repo.list("RED-CHAIR")] == [90]
+
+def test_caching_a_fetched_batch_does_not_load_its_allocations(session, in_memory_db):
+    batch = model.Batch("batchref-1", "RED-CHAIR", 100, None)
+    batch.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 10))
+    respository.SqlRepository(session).add(batch)
+    session.commit()
+    cache = respository.BatchCache()
+
+    statements = count_statements(in_memory_db)
+    fetched = respository.CachingRepository(respository.SqlRepository(session), cache).get("batchref-1")
+    restored = respository.CachingRepository(respository.SqlRepository(session), cache).get("batchref-1")
+
+    assert len(statements) == 1
+    assert (fetched.available_quantity, restored.available_quantity) == (90, 90)
+    assert restored._allocations == {model.OrderLine("orderid-1", "RED-CHAIR", 10)}
+
+def test_saving_a_batch_restored_from_a_stale_snapshot_raises(session_factory):
+    session = session_factory()
+    respository.SqlRepository(session).add(model.Batch("batchref-1", "RED-CHAIR", 10, None))
+    session.commit()
+    cache = respository.BatchCache()
+    first_repo = respository.CachingRepository(respository.SqlRepository(session_factory()), cache)
+    second_repo = respository.CachingRepository(respository.SqlRepository(session_factory()), cache)
+    first, second = first_repo.list(), second_repo.list()
+
+    first[0].allocate(model.OrderLine("orderid-1", "RED-CHAIR", 6))
+    first_repo.add(first[0])
+    first_repo.repo.session.commit()
+    second[0].allocate(model.OrderLine("orderid-2", "RED-CHAIR", 6))
+    with pytest.raises(respository.ConcurrentUpdateError):
+        second_repo.add(second[0])
+
+    assert get_allocations(session, "batchref-1") == {"orderid-1"}
+
+def test_rolled_back_changes_are_not_cached(session_factory):
+    session = session_factory()
+    respository.SqlRepository(session).add(model.Batch("batchref-1", "RED-CHAIR", 10, None))
+    session.commit()
+    cache = respository.BatchCache()
+    first_repo = respository.CachingRepository(respository.SqlRepository(session_factory()), cache)
+    batch = first_repo.get("batchref-1")
+    batch.allocate(model.OrderLine("orderid-1", "RED-CHAIR", 6))
+    first_repo.list("RED-CHAIR") # before saving: the batch only differs in memory
+    first_repo.repo.add(batch) # saved but not committed: its version is bumped
+    first_repo.list("RED-CHAIR")
+    first_repo.repo.session.rollback()
+
+    second_repo = respository.CachingRepository(respository.SqlRepository(session_factory()), cache)
+    [batch] = second_repo.list("RED-CHAIR")
+    assert batch.available_quantity == 10
+    batch.allocate(model.OrderLine("orderid-2", "RED-CHAIR", 6))
+    second_repo.add(batch)
+    second_repo.repo.session.commit()
+
+    assert get_allocations(session, "batchref-1") == {"orderid-2"}
+
+def test_batch_cache_evicts_least_recently_used_and_expired_entries():
+    now = [0.0]
+    cache = respository.BatchCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    for reference in ("batchref-1", "batchref-2"):
+        cache.put_batch(model.Batch(reference, "RED-CHAIR", 100, None))
+    cache.get_batch("batchref-1")
+    cache.put_batch(model.Batch("batchref-3", "RED-CHAIR", 100, None))
+
+    assert cache.get_batch("batchref-2") is None
+    assert cache.get_batch("batchref-1") is not None
+    now[0] = 11
+    assert cache.get_batch("batchref-3") is None
+    assert cache.evictions == 2
+
+
+def seed_batches(session, count: int) -> None:
+    """Helper to bulk insert `count` batches, each with one allocated order line"""
+    session.execute(
+        "INSERT INTO batches (id, reference, sku, _purchased_quantity) VALUES (:id, :reference, :sku, 100)",
+        [dict(id=i, reference=f"batchref-{i}", sku=f"SKU-{i // 10}") for i in range(1, count + 1)],
+    )
+    session.execute(
+        "INSERT INTO order_lines (id, orderid, sku, qty) VALUES (:id, :orderid, :sku, 1)",
+        [dict(id=i, orderid=f"orderid-{i}", sku=f"SKU-{i // 10}") for i in range(1, count + 1)],
+    )
+    session.execute(
+        "INSERT INTO allocations (orderline_id, batch_id) VALUES (:id, :id)",
+        [dict(id=i) for i in range(1, count + 1)],
+    )
+
+def test_get_and_list_stay_fast_as_tables_grow(in_memory_db, session):
+    seed_batches(session, 2_000)
+    executed = []
+    def record(*args):
+        executed.append(args[2:4])
+    event.listen(in_memory_db, "before_cursor_execute", record)
+
+    repo = respository.SqlRepository(session)
+    repo.get("batchref-5")._allocations
+    repo.list(sku="SKU-3")
+    repo.for_order("orderid-7")
+    repo.available_quantities(["SKU-1"])
+    event.remove(in_memory_db, "before_cursor_execute", record)
+
+    assert len(executed) == 5
+    for statement, parameters in executed:
+        plan = [row[-1] for row in session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+        # every table is searched through an index, so lookups do not slow down as tables grow
+        assert not [step for step in plan if step.startswith("SCAN")], plan
+
+def test_repeated_calls_reuse_the_compiled_statements(in_memory_db):
+    session = sessionmaker(bind=in_memory_db)()
+    seed_batches(session, 200)
+
+    def lookups(start):
+        for i in range(start, start + 100):
+            repo = respository.SqlRepository(session)
+            repo.get(f"batchref-{i}")._allocations
+            repo.list(sku=f"SKU-{i}")
+            repo.available_quantities([f"SKU-{i}", f"SKU-{i + 1}"])
+
+    lookups(1)
+    cached = len(in_memory_db._compiled_cache)
+    lookups(101)
+
+    assert len(in_memory_db._compiled_cache) == cached
+
+@pytest.mark.parametrize("query", [
+    "SELECT id FROM batches WHERE reference = 'batchref-1'",
+    "SELECT id FROM batches WHERE sku = 'SKU-1'",
+    "SELECT id FROM order_lines WHERE orderid = 'orderid-1'",
+    "SELECT id FROM allocations WHERE batch_id = 1",
+    "SELECT id FROM allocations WHERE orderline_id = 1",
+])
+def test_lookup_hot_paths_use_an_index(session, query):
+    plan = " ".join(row[-1] for row in session.execute(f"EXPLAIN QUERY PLAN {query}"))
+    assert "USING INDEX" in plan or "USING COVERING INDEX" in plan
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import (
+    List,
+    Optional,
+)
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from db_tables import metadata
+import model
+import respository
+import services
+import unit_of_work
+
+
+def add_batches(session_factory, *batches):
+    session = session_factory()
+    respository.SqlRepository(session).add_all(batches)
+    session.commit()
+
+
+def test_allocate_returns_allocation_and_commits(session_factory):
+    add_batches(session_factory, model.Batch("b1", "COMPLICATED-LAMP", 100, None))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    result = services.allocate(model.OrderLine("o1", "COMPLICATED-LAMP", 10), uow)
+
+    assert result == "b1"
+    with uow:
+        assert uow.batches.get("b1").available_quantity == 90
+
+def test_allocate_errors_when_out_of_stock(session_factory):
+    add_batches(session_factory, model.Batch("b1", "AREALSKU", 5, None))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    with pytest.raises(model.OutOfStock, match="AREALSKU"):
+        services.allocate(model.OrderLine("o1", "AREALSKU", 10), uow)
+
+def test_allocate_lines_groups_allocations_into_few_commits(session_factory, in_memory_db):
+    add_batches(
+        session_factory,
+        model.Batch("b1", "RED-CHAIR", 50, None),
+        model.Batch("b2", "BLUE-SOFA", 5, None),
+    )
+    commits = []
+    event.listen(in_memory_db, "commit", lambda connection: commits.append(connection))
+    lines = [model.OrderLine(f"o{i}", "RED-CHAIR" if i % 2 else "BLUE-SOFA", 1) for i in range(40)]
+
+    results = services.allocate_lines(lines, unit_of_work.SqlAlchemyUnitOfWork(session_factory), commit_every=15)
+
+    assert len(commits) == 3
+    assert results.count("b1") == 20
+    assert results.count("b2") == 5
+    assert results.count(None) == 15
+    session = session_factory()
+    assert list(session.execute("SELECT COUNT(*) FROM allocations")) == [(25,)]
+
+
+def test_deallocate_removes_an_order_from_every_batch(session_factory):
+    chair = model.Batch("b1", "RED-CHAIR", 10, None)
+    chair.allocate(model.OrderLine("o1", "RED-CHAIR", 4))
+    chair.allocate(model.OrderLine("o2", "RED-CHAIR", 1))
+    lamp = model.Batch("b2", "RED-LAMP", 10, None)
+    lamp.allocate(model.OrderLine("o1", "RED-LAMP", 3))
+    add_batches(session_factory, chair, lamp)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    removed = services.deallocate("o1", uow)
+
+    assert set(removed) == {model.OrderLine("o1", "RED-CHAIR", 4), model.OrderLine("o1", "RED-LAMP", 3)}
+    with uow:
+        assert uow.batches.get("b1")._allocations == {model.OrderLine("o2", "RED-CHAIR", 1)}
+        assert uow.batches.get("b2").available_quantity == 10
+
+def test_reallocate_moves_an_order_to_the_preferred_batch(session_factory):
+    shipment = model.Batch("b1", "RED-CHAIR", 10, date(2030, 1, 1))
+    shipment.allocate(model.OrderLine("o1", "RED-CHAIR", 4))
+    warehouse = model.Batch("b2", "RED-CHAIR", 10, None)
+    add_batches(session_factory, shipment, warehouse)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    assert services.reallocate("o1", uow) == ["b2"]
+    with uow:
+        assert uow.batches.get("b1").available_quantity == 10
+        assert uow.batches.get("b2").available_quantity == 6
+
+def test_concurrent_allocations_to_one_sku_never_over_allocate(tmp_path):
+    engine = unit_of_work.create_engine_from_config(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    add_batches(
+        session_factory,
+        model.Batch("b1", "HOT-SKU", 30, None),
+        model.Batch("b2", "HOT-SKU", 30, None),
+    )
+
+    def worker(worker_id: int) -> List[Optional[str]]:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        results = []
+        for i in range(10):
+            try:
+                results.append(services.allocate(model.OrderLine(f"o{worker_id}-{i}", "HOT-SKU", 1), uow, max_attempts=100))
+            except model.OutOfStock:
+                results.append(None)
+        return results
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = [result for results in executor.map(worker, range(8)) for result in results]
+
+    session = session_factory()
+    allocated = dict(session.execute(
+        "SELECT b.reference, COUNT(*) FROM allocations a JOIN batches b ON a.batch_id = b.id GROUP BY b.reference"
+    ).fetchall())
+    assert allocated == {"b1": 30, "b2": 30}
+    assert results.count("b1") == 30 and results.count("b2") == 30
+    assert results.count(None) == 20
+
+def test_conflicting_writes_raise_concurrent_update_error(session_factory):
+    add_batches(session_factory, model.Batch("b1", "RED-CHAIR", 10, None))
+    first, second = respository.SqlRepository(session_factory()), respository.SqlRepository(session_factory())
+    first_batch, second_batch = first.get("b1", lazy=False), second.get("b1", lazy=False)
+
+    first_batch.allocate(model.OrderLine("o1", "RED-CHAIR", 6))
+    first.add(first_batch)
+    first.session.commit()
+
+    second_batch.allocate(model.OrderLine("o2", "RED-CHAIR", 6))
+    with pytest.raises(respository.ConcurrentUpdateError):
+        second.add(second_batch)
@@ -0,0 +1,83 @@
+from datetime import date
+
+import pytest
+
+import model
+import respository
+import snapshot
+
+
+def add_batches(session, *batches):
+    respository.SqlRepository(session).add_all(batches)
+    session.commit()
+
+def seed(session):
+    batches = []
+    for i in range(6):
+        batch = model.Batch(f"batch-{i}", f"SKU-{i % 2}", 100, None if i % 3 == 0 else date(2030, 1, 10 - i))
+        for j in range(i):
+            batch.allocate(model.OrderLine(f"order-{i}-{j}", batch.sku, j + 1))
+        batches.append(batch)
+    add_batches(session, *batches)
+    return batches
+
+
+def test_snapshot_round_trips_batches_in_allocation_order(session, tmp_path):
+    batches = seed(session)
+    path = str(tmp_path / "inventory.snapshot")
+
+    snapshot.save(snapshot.take(session), path)
+    loaded = snapshot.load(path)
+
+    assert snapshot.read_marker(path) == loaded.marker == snapshot.database_marker(session)
+    by_reference = {batch.reference: batch for batch in batches}
+    for batch in loaded.batches():
+        original = by_reference[batch.reference]
+        assert (batch.sku, batch.eta, batch._purchased_quantity) == (original.sku, original.eta, original._purchased_quantity)
+        assert batch.version_number == loaded.entries[batch.reference].version_number
+        assert batch.available_quantity == original.available_quantity
+        assert batch._allocations == original._allocations
+    index = model.AllocationIndex(batches)
+    for sku in ("SKU-0", "SKU-1"):
+        assert loaded.index().batches_for(sku) == index.batches_for(sku)
+
+def test_refresh_reloads_only_new_and_changed_batches(session, tmp_path):
+    seed(session)
+    path = str(tmp_path / "inventory.snapshot")
+    snapshot.save(snapshot.take(session), path)
+    repo = respository.SqlRepository(session)
+    changed = repo.get("batch-2")
+    changed.allocate(model.OrderLine("order-new", "SKU-0", 5))
+    repo.add_all([changed, model.Batch("batch-new", "SKU-1", 10, None)])
+    session.commit()
+
+    loaded = snapshot.load(path)
+    unchanged = loaded.entries["batch-1"]
+    assert not snapshot.is_current(loaded, session)
+
+    assert snapshot.refresh(loaded, session) == 2
+    assert snapshot.is_current(loaded, session)
+    assert loaded.entries["batch-1"] is unchanged
+    assert model.OrderLine("order-new", "SKU-0", 5) in loaded.entries["batch-2"].batch._allocations
+    assert loaded.entries["batch-new"].batch.available_quantity == 10
+    assert snapshot.refresh(loaded, session) == 0
+
+def test_warm_start_takes_a_snapshot_once_then_tops_it_up(session, tmp_path):
+    seed(session)
+    path = str(tmp_path / "inventory.snapshot")
+
+    first = snapshot.warm_start(path, session)
+    add_batches(session, model.Batch("batch-new", "SKU-1", 10, None))
+    second = snapshot.warm_start(path, session)
+
+    assert len(first.entries) == 6
+    assert len(second.entries) == 7
+    assert snapshot.read_marker(path) == snapshot.database_marker(session)
+
+def test_other_files_are_rejected(tmp_path):
+    for content in (b"", b"hello world" * 10):
+        path = tmp_path / "not-a.snapshot"
+        path.write_bytes(content)
+
+        with pytest.raises(snapshot.InvalidSnapshot):
+            snapshot.load(str(path))
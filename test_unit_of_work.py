@@ -0,0 +1,89 @@
+import pytest
+from sqlalchemy import event
+
+import model
+import unit_of_work
+
+
+def insert_batch(session, reference, sku, qty, eta=None):
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES (:reference, :sku, :qty, :eta)",
+        dict(reference=reference, sku=sku, qty=qty, eta=eta),
+    )
+
+def get_allocated_batch_ref(session, orderid, sku):
+    [[batchref]] = session.execute(
+        """
+        SELECT b.reference FROM allocations a
+        JOIN order_lines ol ON a.orderline_id = ol.id
+        JOIN batches b ON a.batch_id = b.id
+        WHERE ol.orderid = :orderid AND ol.sku = :sku
+        """,
+        dict(orderid=orderid, sku=sku),
+    )
+    return batchref
+
+
+def test_uow_can_retrieve_a_batch_and_allocate_to_it(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 100)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        batch = uow.batches.get("batch1")
+        batch.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+        uow.commit()
+
+    assert get_allocated_batch_ref(session, "o1", "HIPSTER-WORKBENCH") == "batch1"
+
+def test_rolls_back_uncommitted_work_by_default(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        uow.batches.add(model.Batch("batch1", "MEDIUM-PLINTH", 100, None))
+
+    session = session_factory()
+    assert list(session.execute("SELECT * FROM batches")) == []
+
+def test_rolls_back_on_error(session_factory):
+    class MyException(Exception):
+        pass
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with pytest.raises(MyException):
+        with uow:
+            uow.batches.add(model.Batch("batch1", "LARGE-FORK", 100, None))
+            raise MyException()
+
+    session = session_factory()
+    assert list(session.execute("SELECT * FROM batches")) == []
+
+def test_many_allocations_share_a_single_commit(session_factory, in_memory_db):
+    session = session_factory()
+    insert_batch(session, "batch1", "RED-CHAIR", 100)
+    insert_batch(session, "batch2", "BLUE-SOFA", 100)
+    session.commit()
+    commits = []
+    event.listen(in_memory_db, "commit", lambda connection: commits.append(connection))
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        for i in range(10):
+            for batch in uow.batches.list():
+                batch.allocate(model.OrderLine(f"order-{i}", batch.sku, 1))
+        uow.commit()
+
+    assert len(commits) == 1
+    assert [(ref, qty) for ref, qty in session.execute(
+        "SELECT b.reference, COUNT(*) FROM allocations a JOIN batches b ON a.batch_id = b.id GROUP BY b.reference"
+    )] == [("batch1", 10), ("batch2", 10)]
+
+def test_file_backed_sqlite_engines_are_pooled_and_tuned(tmp_path):
+    engine = unit_of_work.create_engine_from_config(f"sqlite:///{tmp_path / 'allocation.db'}", pool_size=3)
+
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1 # NORMAL
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+    assert engine.pool.size() == 3
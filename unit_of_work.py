@@ -0,0 +1,138 @@
+import abc
+import os
+from typing import Dict
+from typing import Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from eventlog import AllocationEventLog
+import respository
+
+
+# pragmas applied to every new SQLite connection: WAL lets readers carry on while a
+# writer commits, and synchronous=NORMAL only fsyncs the WAL at checkpoints
+DEFAULT_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+}
+
+
+def create_engine_from_config(
+    url: str,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_pre_ping: bool = True,
+    pool_recycle: int = 3600,
+    sqlite_pragmas: Optional[Dict[str, object]] = None,
+) -> Engine:
+    """
+    Create an engine with the pooling options used by the allocation service:
+
+    * server databases get a QueuePool of `pool_size` (+ `max_overflow`) connections,
+      checked with a ping before use and recycled after `pool_recycle` seconds
+    * file-backed SQLite also pools its connections, and every new connection
+      gets `sqlite_pragmas` (DEFAULT_SQLITE_PRAGMAS unless given)
+    * in-memory SQLite keeps SQLAlchemy's default single connection per thread
+    """
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        return create_engine(
+            url,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            pool_recycle=pool_recycle,
+        )
+
+    if url.database and url.database != ":memory:":
+        engine = create_engine(
+            url,
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            connect_args=dict(check_same_thread=False),
+        )
+    else:
+        engine = create_engine(url)
+
+    pragmas = DEFAULT_SQLITE_PRAGMAS if sqlite_pragmas is None else sqlite_pragmas
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+DEFAULT_SESSION_FACTORY = sessionmaker(
+    bind=create_engine_from_config(os.environ.get("DATABASE_URL", "sqlite:///allocation.db"))
+)
+
+
+class AbstractUnitOfWork(abc.ABC):
+    batches: respository.AbstractRepository
+    event_log: Optional[AllocationEventLog] = None
+
+    def __enter__(self) -> "AbstractUnitOfWork":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.rollback() # anything not explicitly committed is discarded
+
+    @abc.abstractmethod
+    def commit(self) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rollback(self) -> None:
+        raise NotImplementedError
+
+
+class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
+    """
+    One transaction around a SqlRepository.
+
+    Batches loaded or added through `batches` are tracked by the repository, so
+    `commit` writes every change made to them since the last commit in bulk
+    and then commits once: many allocations can share a single commit (and
+    fsync) by committing after the last of them.
+
+    With an `event_log`, the tracked batches record their events, which are
+    added to the log once the commit succeeded. Without one no events are kept.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker = DEFAULT_SESSION_FACTORY,
+        event_log: Optional[AllocationEventLog] = None,
+    ):
+        self.session_factory = session_factory
+        self.event_log = event_log
+
+    def __enter__(self) -> "SqlAlchemyUnitOfWork":
+        self.session = self.session_factory()
+        self.batches = respository.SqlRepository(self.session, record_events=self.event_log is not None)
+        return super().__enter__()
+
+    def __exit__(self, *args) -> None:
+        super().__exit__(*args)
+        self.session.close()
+
+    def commit(self) -> None:
+        self.batches.flush()
+        self.session.commit()
+        if self.event_log is not None:
+            self.event_log.record(self.batches.collect_events())
+
+    def rollback(self) -> None:
+        self.session.rollback()